@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Compare the line diff engine with diff_match_patch on stored outputs.
+
+The outputs of a sample of mismatched test case results (those whose output
+is stored, see `TestCaseResult.output`) are diffed against their expected
+output with both engines. The time taken to produce the side-by-side rows
+and the number of differing rows are reported.
+
+"""
+import sys
+import time
+from argparse import ArgumentParser
+from diff_match_patch import diff_match_patch as DMP
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+
+from submit.diff_unit import dmp_to_mdiff
+from submit.line_diff import line_diff
+from submit.models import File, Session, TestCaseResult
+
+
+def dmp_diff(correct, given):
+    """Return the diff as it was made with diff_match_patch."""
+    dmp = DMP()
+    dmp.Diff_Timeout = 4
+    text1, text2, array = dmp.diff_linesToChars(correct, given)
+    diffs = dmp.diff_main(text1, text2)
+    dmp.diff_cleanupSemantic(diffs)
+    dmp.diff_charsToLines(diffs, array)
+    return diffs
+
+
+def measure(engine, correct, given):
+    """Return the seconds taken, the number of rows and of differing rows."""
+    start = time.time()
+    rows = list(dmp_to_mdiff(engine(correct, given)))
+    return (time.time() - start, len(rows),
+            sum(1 for _, _, differs in rows if differs))
+
+
+def read(base_path, file_):
+    with open(File.file_path(base_path, file_.sha1)) as fp:
+        return fp.read()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config_uri', help='(example: "development.ini")')
+    parser.add_argument('--sample', type=int, default=200,
+                        help='the number of results to diff (default: 200)')
+    args = parser.parse_args()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+    base_path = settings['file_directory']
+
+    results = (Session.query(TestCaseResult)
+               .filter(TestCaseResult.output_matches == False)  # NOQA
+               .filter(TestCaseResult.output_id != None)  # NOQA
+               .order_by(TestCaseResult.submission_id.desc())
+               .limit(args.sample).all())
+    engines = (('diff_match_patch', dmp_diff), ('line_diff', line_diff))
+    totals = {name: [0., 0., 0] for name, _ in engines}
+    differences = 0
+    for result in results:
+        correct = read(base_path, result.test_case.expected)
+        given = read(base_path, result.output)
+        measured = {}
+        for name, function in engines:
+            measured[name] = measure(function, correct, given)
+            seconds, _, differing = measured[name]
+            totals[name][0] += seconds
+            totals[name][1] = max(totals[name][1], seconds)
+            totals[name][2] += differing
+        if measured['diff_match_patch'][2] != measured['line_diff'][2]:
+            differences += 1
+
+    count = max(1, len(results))
+    print('{} outputs diffed ({} with a different number of differing rows)'
+          .format(len(results), differences))
+    for name, _ in engines:
+        seconds, slowest, differing = totals[name]
+        print('{:<16} {:8.3f} ms mean, {:8.3f} ms max, {:6.1f} differing '
+              'rows mean'.format(name, seconds * 1000 / count, slowest * 1000,
+                                 differing / float(count)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
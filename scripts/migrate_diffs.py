@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Convert pickled diffs to the compact diff format.
+
+The lines of both outputs are recovered from each pickled diff and stored as
+files which the compact diff references. A diff is only replaced when its
+compact form decodes to exactly the same rows, so the conversion can safely
+run in the background, and be interrupted, while the site is in use.
+
+With --benchmark nothing is written; instead the size and decode time of a
+sample of the pickled diffs are compared with their compact form.
+
+"""
+import sys
+import time
+import transaction
+from argparse import ArgumentParser
+from hashlib import sha1
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+
+from submit import legacy_pickle
+from submit.diff_unit import LazyDiff
+from submit.models import (DiffCache, File, Session, TestCase,
+                           TestCaseResult)
+
+BATCH_SIZE = 100
+# The number of rows the submission view shows of a long diff
+SHOWN_ROWS = 512
+
+
+def strip_markers(text, differs):
+    """Return the line of output within a row of the diff."""
+    if differs and text.startswith(('\0-', '\0+')) and text.endswith('\1'):
+        return text[2:-1]
+    return text
+
+
+def expand(diff):
+    """Return the correct and given outputs the diff was made from."""
+    correct = []
+    given = []
+    for (left_num, left), (right_num, right), differs in diff._diff:
+        if left_num != '':
+            correct.append(strip_markers(left, differs))
+        if right_num != '':
+            given.append(strip_markers(right, differs))
+    return ''.join(correct), ''.join(given)
+
+
+def convert(data):
+    """Return the compact diff and the correct and given outputs.
+
+    None is returned when the pickled diff cannot be represented exactly.
+
+    """
+    try:
+        diff = legacy_pickle.loads(data)
+        if diff.outputs_match():
+            return None
+        correct, given = expand(diff)
+        outputs = {sha1(correct).hexdigest(): correct,
+                   sha1(given).hexdigest(): given}
+        compact = diff.serialize(sha1(correct).hexdigest(),
+                                 sha1(given).hexdigest())
+        decoded = LazyDiff(compact, outputs.get)
+        if list(decoded._diff) != list(diff._diff) or \
+                decoded.get_issue() != diff.get_issue():
+            return None
+    except Exception:
+        return None
+    return compact, correct, given
+
+
+def pickled_diff_ids():
+    """Return the ids of the files storing the diffs of test case results."""
+    query = (Session.query(TestCaseResult.diff_id).distinct()
+             .join(TestCase, TestCase.id == TestCaseResult.test_case_id)
+             .filter(TestCase.output_type == 'diff')
+             .filter(TestCaseResult.diff_id != None))  # NOQA
+    return sorted(x[0] for x in query)
+
+
+def read(base_path, file_):
+    with open(File.file_path(base_path, file_.sha1)) as fp:
+        return fp.read()
+
+
+def migrate(base_path):
+    converted = skipped = 0
+    file_ids = pickled_diff_ids()
+    for start in range(0, len(file_ids), BATCH_SIZE):
+        for file_ in File.query_by().filter(
+                File.id.in_(file_ids[start:start + BATCH_SIZE])):
+            data = read(base_path, file_)
+            if LazyDiff.is_compact(data):
+                continue
+            result = convert(data)
+            if not result:
+                skipped += 1
+                continue
+            compact, correct, given = result
+            File.fetch_or_create(correct, base_path)
+            File.fetch_or_create(given, base_path)
+            diff = File.fetch_or_create(compact, base_path)
+            (Session.query(TestCaseResult)
+             .filter(TestCaseResult.diff_id == file_.id)
+             .update({'diff_id': diff.id}, synchronize_session=False))
+            (Session.query(DiffCache).filter(DiffCache.diff_id == file_.id)
+             .update({'diff_id': diff.id}, synchronize_session=False))
+            converted += 1
+        transaction.commit()
+        print('{} of {} diffs: {} converted, {} skipped'.format(
+            min(start + BATCH_SIZE, len(file_ids)), len(file_ids), converted,
+            skipped))
+
+
+def benchmark(base_path, sample):
+    stats = {'compact_bytes': 0, 'compact_decode': 0., 'compact_first': 0.,
+             'count': 0, 'output_bytes': 0, 'pickle_bytes': 0,
+             'pickle_decode': 0., 'skipped': 0}
+    for file_ in File.query_by().filter(
+            File.id.in_(pickled_diff_ids()[-sample:])):
+        data = read(base_path, file_)
+        if LazyDiff.is_compact(data):
+            continue
+        result = convert(data)
+        if not result:
+            stats['skipped'] += 1
+            continue
+        compact, correct, given = result
+        outputs = {sha1(correct).hexdigest(): correct,
+                   sha1(given).hexdigest(): given}
+        start = time.time()
+        list(legacy_pickle.loads(data)._diff)
+        stats['pickle_decode'] += time.time() - start
+        start = time.time()
+        rows = LazyDiff(compact, outputs.get)._diff
+        for _ in zip(range(SHOWN_ROWS), rows):
+            pass
+        stats['compact_first'] += time.time() - start
+        list(rows)
+        stats['compact_decode'] += time.time() - start
+        stats['compact_bytes'] += len(compact)
+        stats['output_bytes'] += len(given)
+        stats['pickle_bytes'] += len(data)
+        stats['count'] += 1
+    count = max(1, stats['count'])
+    print('{} diffs sampled ({} cannot be converted)'.format(
+        stats['count'], stats['skipped']))
+    print('pickle:  {:>12} bytes, {:.3f} ms to decode'.format(
+        stats['pickle_bytes'], stats['pickle_decode'] * 1000 / count))
+    print('compact: {:>12} bytes, {:.3f} ms to decode ({:.3f} ms for the '
+          'first {} rows)'.format(
+              stats['compact_bytes'], stats['compact_decode'] * 1000 / count,
+              stats['compact_first'] * 1000 / count, SHOWN_ROWS))
+    print('         {:>12} bytes of output stored once and shared'.format(
+        stats['output_bytes']))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config_uri', help='(example: "development.ini")')
+    parser.add_argument('--benchmark', metavar='SAMPLE', type=int,
+                        help='compare SAMPLE pickled diffs with their compact '
+                        'form without converting them')
+    args = parser.parse_args()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    if args.benchmark:
+        benchmark(settings['file_directory'], args.benchmark)
+    else:
+        migrate(settings['file_directory'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
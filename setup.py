@@ -58,6 +58,7 @@ setup(name=PACKAGE_NAME,
       license='Simplified BSD License',
       long_description=README,
       packages=find_packages(),
+      test_suite='submit.tests',
       url='https://github.com/ucsb-cs/submit',
       version=VERSION,
       zip_safe=False)
@@ -4,6 +4,7 @@ from pyramid.config import Configurator
 from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
 from sqlalchemy import engine_from_config
+from .diff_render import FragmentCache
 from .helpers import get_queue_func
 from .models import configure_sql, create_schema, populate_database
 from .security import get_user, group_finder
@@ -53,6 +54,8 @@ def add_routes(config):
     config.add_route('session', '/session')
     config.add_route('submission', '/submission')
     config.add_route('submission_item', '/submission/{submission_id}')
+    config.add_route('submission_item_diff',
+                     '/submission/{submission_id}/diff/{test_case_id}')
     config.add_route('submission_item_gen', '/submission/{submission_id}/gen')
     config.add_route('test_case', '/test_case')
     config.add_route('test_case_item', '/test_case/{test_case_id}')
@@ -100,6 +103,11 @@ def main(global_config, **settings):
                           authorization_policy=author, root_factory=Root,
                           session_factory=session_factory)
     config.add_static_view('static', 'static', cache_max_age=3600)
+    config.registry.rendered_diff_cache = FragmentCache(
+        int(settings.get('rendered_diff_cache_size', 1024)),
+        settings.get('rendered_diff_cache_directory') or None,
+        int(settings.get('rendered_diff_cache_directory_size', 256)) *
+        1024 * 1024)
     # Add attributes to request
     config.add_request_method(get_user, 'user', reify=True)
     config.add_request_method(get_queue_func, 'queue', reify=True)
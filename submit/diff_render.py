@@ -1,4 +1,11 @@
 import difflib
+import errno
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
 
 _file_template = """
 <div id="diff_table_div">
@@ -42,6 +49,8 @@ MAX_DIFF_LINES = 512
 LINE_WRAP = 64
 SOFT_MAX_LINE_LENGTH = 128
 HARD_MAX_LINE_LENGTH = 1024
+# Bump when a change alters the HTML of rendered diff tables
+RENDER_VERSION = 1
 
 
 def limit_revealed_lines_to(diffs, limit, hide_expected):
@@ -78,6 +87,42 @@ def limit_revealed_lines_to(diffs, limit, hide_expected):
         yield fromdata, todata, flag
 
 
+def diff_hunks(diff, limit=MAX_NUM_REVEALS):
+    """Return the shown rows of the diff grouped into hunks.
+
+    The same rules as the rendered table apply (see `limit_revealed_lines_to`).
+    A run of lines common to both outputs is [0, from_line, to_line, lines]
+    and a run of differing rows is [1, rows] where each row is [from_line,
+    from_text, to_line, to_text]. The line numbers of padding rows are None,
+    as is the expected text when it is hidden. Differing text keeps its \\0+,
+    \\0-, \\0^ ... \\1 markers.
+
+    """
+    def text(value):
+        return value.replace('\n', '').decode('utf-8', 'ignore')
+
+    hide_expected = diff.hide_expected
+    hunks = []
+    truncated = False
+    for (from_line, from_text), (to_line, to_text), flag in \
+            limit_revealed_lines_to(diff._diff, limit, hide_expected):
+        if from_line == '...':
+            truncated = True
+            break
+        if flag:
+            if not hunks or hunks[-1][0] != 1:
+                hunks.append([1, []])
+            hunks[-1][1].append([
+                from_line or None, None if hide_expected else text(from_text),
+                to_line or None, text(to_text)])
+        else:
+            if not hunks or hunks[-1][0] != 0:
+                hunks.append([0, from_line, to_line, []])
+            hunks[-1][3].append(text(to_text))
+    return {'hide_expected': hide_expected, 'hunks': hunks,
+            'truncated': truncated}
+
+
 def change_same_starting_points(flaglist):
     """Gets points at which changes begin"""
 
@@ -99,6 +144,120 @@ def change_same_starting_points(flaglist):
     return (change_points, same_points)
 
 
+def prune_files(directory, max_bytes):
+    """Remove the least recently used files until directory holds max_bytes.
+
+    Files are ordered by their modification time, thus readers mark a file as
+    recently used by touching it. Files whose name starts with a dot, e.g.,
+    ones not yet published, are left alone.
+
+    """
+    files = []
+    total = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                info = os.stat(path)
+            except OSError:  # Removed by another process
+                continue
+            files.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+class FragmentCache(object):
+    """A bounded LRU cache of rendered HTML fragments.
+
+    When `directory` is set fragments are also written there, so they outlive
+    eviction and are shared by every process serving the site. The directory
+    can be cleared at any time. Fragments read from it are touched, and every
+    SWEEP_INTERVAL seconds the least recently used are removed until the
+    directory holds at most `max_bytes`.
+
+    """
+
+    SWEEP_INTERVAL = 300
+
+    def __init__(self, max_entries, directory=None, max_bytes=None):
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.swept_at = 0
+
+    @staticmethod
+    def key(*parts):
+        return sha1(repr(parts)).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                return value
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                value = fp.read()
+            os.utime(path, None)  # Mark as recently used
+        except EnvironmentError:
+            return None
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                             delete=False) as fp:
+                fp.write(value)
+            os.rename(fp.name, path)
+        except EnvironmentError:  # The fragment remains cached in memory
+            pass
+        with self.lock:
+            sweep = self.max_bytes and \
+                time.time() - self.swept_at >= self.SWEEP_INTERVAL
+            if sweep:
+                self.swept_at = time.time()
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """Remove the least recently used fragments from the directory."""
+        prune_files(self.directory, self.max_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
 class HTMLDiff(difflib.HtmlDiff):
     FROM_DESC = 'Correct Output'
     TO_DESC = 'Your Output'
@@ -120,10 +279,24 @@ class HTMLDiff(difflib.HtmlDiff):
         '<a href="javascript:void(0)" onclick="showHideRows(this);">h</a>'
     NO_DIFFERENCES = '<td></td><td>&nbsp;No Differences Found&nbsp;</td>'
     EMPTY_FILE = '<td></td><td>&nbsp;Empty File&nbsp;</td>'
+    DIFF_PLACEHOLDER = ('<div class="diff_placeholder" data-url="{0}">'
+                        '<a href="javascript:void(0)" onclick="toggleDiff('
+                        'this.parentNode);">Show diff</a></div>')
     MAX_SAME_LINES_BEFORE_SHOW_HIDE = 5  # must be >= 4
 
-    def __init__(self, points_possible=0, num_reveal_limit=MAX_NUM_REVEALS):
+    def __init__(self, points_possible=0, num_reveal_limit=MAX_NUM_REVEALS,
+                 cache=None, diff_url=None):
+        """Render the diffs of a submission.
+
+        Rendered tables are stored in and reused from `cache` (a
+        FragmentCache) when given. When `diff_url` is given tables are not
+        rendered at all; instead each is loaded by the browser, when opened,
+        from the url `diff_url` returns for the renderable.
+
+        """
         super(HTMLDiff, self).__init__(wrapcolumn=LINE_WRAP)
+        self._cache = cache
+        self._diff_url = diff_url
         self._legend = _legend
         self._table_template = _table_template
         self._file_template = _file_template
@@ -137,12 +310,20 @@ class HTMLDiff(difflib.HtmlDiff):
         value = renderable.custom_output
         if renderable.show_diff_table():
             self._show_legend = True
-            self._last_collapsed = False
-            table = self.make_table(renderable)
-            if self._last_collapsed:
-                show_hide = self.SHOW_HIDE_INSTRUMENTATION.format(
-                    self._prefix[1])
-                table = '{0}{1}{0}'.format(show_hide, table)
+            key = table = None
+            if self._diff_url:
+                table = self.DIFF_PLACEHOLDER.format(
+                    self._diff_url(renderable))
+            elif self._cache and renderable.sha1:
+                # The table is determined by the diff and how it is shown
+                key = self._cache.key(
+                    RENDER_VERSION, renderable.sha1, renderable.number,
+                    renderable.diff.hide_expected, self._num_reveal_limit)
+                table = self._cache.get(key)
+            if table is None:
+                table = self.make_collapsible_table(renderable)
+                if key:
+                    self._cache.set(key, table)
             value += table
         name = renderable.name
         issue = renderable.get_issue()
@@ -152,10 +333,19 @@ class HTMLDiff(difflib.HtmlDiff):
             self.FAILING_BLOCK.format(renderable.id, renderable.group, name,
                                       value)
 
+    def make_collapsible_table(self, renderable):
+        """Return the table with links to show and hide its same regions."""
+        self._last_collapsed = False
+        table = self.make_table(renderable)
+        if self._last_collapsed:
+            show_hide = self.SHOW_HIDE_INSTRUMENTATION.format(self._prefix[1])
+            table = '{0}{1}{0}'.format(show_hide, table)
+        return table
+
     def make_table(self, renderable):
         """Makes unique anchor prefixes so that multiple tables may exist
         on the same page without conflict."""
-        self._make_prefix()
+        self._make_prefix(renderable.number)
         diffs = renderable.diff._diff
 
         # set up iterator to wrap lines that exceed desired width
@@ -262,10 +452,15 @@ class HTMLDiff(difflib.HtmlDiff):
                                         hide_expected)
         return super(HTMLDiff, self)._line_wrapper(diffs)
 
-    def _make_prefix(self):
-        sameprefix = "same{0}_".format(HTMLDiff._default_prefix)
-        super(HTMLDiff, self)._make_prefix()
-        self._prefix.append(sameprefix)
+    def _make_prefix(self, number):
+        """Make the anchor prefixes from the renderable's (unique) number.
+
+        Unlike difflib's global counter the prefixes do not depend on the
+        tables rendered before, which allows rendered tables to be cached.
+
+        """
+        self._prefix = ['from{0}_'.format(number), 'to{0}_'.format(number),
+                        'same{0}_'.format(number)]
 
     def _convert_flags(self, fromlist, tolist, flaglist, context, numlines):
         """Handles making inline links in the document."""
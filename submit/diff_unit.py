@@ -1,6 +1,11 @@
+import json
 import xml.sax.saxutils
 from diff_match_patch import diff_match_patch as DMP
 from .helpers import alphanum_key
+from .line_diff import line_diff
+
+COMPACT_MAGIC = '#submit-diff'
+COMPACT_VERSION = 1
 
 
 def dmp_to_mdiff(diffs):
@@ -95,10 +100,15 @@ class Renderable(object):
 
 
 class DiffWithMetadata(Renderable):
-    def __init__(self, diff, **kwargs):
-        """Diff is None when the outputs match."""
+    def __init__(self, diff, sha1=None, **kwargs):
+        """Diff is None when the outputs match.
+
+        `sha1` identifies the stored diff.
+
+        """
         super(DiffWithMetadata, self).__init__(**kwargs)
         self.diff = diff
+        self.sha1 = sha1
 
     def show_diff_table(self):
         return self.status != 'nonexistent_executable' and \
@@ -130,14 +140,20 @@ class TextOutput(Renderable):
 class Diff(object):
     """Represents a saved diff file.  Can be pickled safely."""
 
-    def __init__(self, correct, given):
+    def __init__(self, correct, given, coarse=False):
+        """Diff the outputs.
+
+        A coarse diff only trims the lines the outputs have in common at
+        their start and end, and is used when the full diff takes too long.
+
+        """
         self._tabsize = 8
         self._correct_empty = correct == ""
         self._given_empty = given == ""
         self._correct_newline = correct.endswith('\n')
         self._given_newline = given.endswith('\n')
-        self._diff = self._make_diff(correct, given) \
-            if correct != given else None
+        make_diff = self._make_coarse_diff if coarse else self._make_diff
+        self._diff = make_diff(correct, given) if correct != given else None
 
     @property
     def correct_empty(self):
@@ -220,13 +236,111 @@ class Diff(object):
 
     def _make_diff(self, correct, given):
         """Return the intermediate representation of the diff."""
-        dmp = DMP()
-        dmp.Diff_Timeout = 4
-        text1, text2, array = dmp.diff_linesToChars(correct, given)
-        diffs = dmp.diff_main(text1, text2)
-        dmp.diff_cleanupSemantic(diffs)
-        dmp.diff_charsToLines(diffs, array)
-        return list(dmp_to_mdiff(diffs))
+        return list(dmp_to_mdiff(line_diff(correct, given)))
+
+    def _make_coarse_diff(self, correct, given):
+        """Return the intermediate representation of a coarse diff."""
+        return list(dmp_to_mdiff(line_diff(correct, given, max_edits=0)))
+
+    def opcodes(self):
+        """Return the diff as a list of [op, count] runs of lines.
+
+        `op` is `=` for lines in both outputs, `-` for lines only in the
+        correct output and `+` for lines only in the given output.
+
+        """
+        opcodes = []
+
+        def add(op, count):
+            if not count:
+                return
+            if opcodes and opcodes[-1][0] == op:
+                opcodes[-1][1] += count
+            else:
+                opcodes.append([op, count])
+
+        deleted = inserted = 0
+        for (left, _), (right, _), differs in self._diff or []:
+            if differs:
+                deleted += left != ''
+                inserted += right != ''
+                continue
+            add('-', deleted)
+            add('+', inserted)
+            deleted = inserted = 0
+            add('=', 1)
+        add('-', deleted)
+        add('+', inserted)
+        return opcodes
+
+    def serialize(self, expected_sha1, actual_sha1):
+        """Return the compact representation of the diff.
+
+        No lines are stored. Instead they are referenced from the expected and
+        actual output files identified by their sha1sums.
+
+        """
+        meta = {'actual': actual_sha1, 'correct_empty': self.correct_empty,
+                'correct_newline': self.correct_newline,
+                'expected': expected_sha1, 'given_empty': self.given_empty,
+                'given_newline': self.given_newline}
+        lines = ['{} {}'.format(COMPACT_MAGIC, COMPACT_VERSION),
+                 json.dumps(meta, sort_keys=True)]
+        lines.extend('{}{}'.format(op, count) for op, count in self.opcodes())
+        return '\n'.join(lines) + '\n'
+
+
+class LazyDiff(Diff):
+    """A diff decoded from its compact representation.
+
+    `read` returns the contents of a file given its sha1sum. The rows of the
+    diff are produced on demand so rendering a truncated diff does not build
+    the rows it does not show.
+
+    """
+
+    def __init__(self, data, read):
+        header, meta, self._opcodes = data.split('\n', 2)
+        if header != '{} {}'.format(COMPACT_MAGIC, COMPACT_VERSION):
+            raise ValueError('Unsupported diff format: {}'.format(header))
+        meta = json.loads(meta)
+        self._tabsize = 8
+        self._correct_empty = meta['correct_empty']
+        self._given_empty = meta['given_empty']
+        self._correct_newline = meta['correct_newline']
+        self._given_newline = meta['given_newline']
+        self._expected_sha1 = meta['expected']
+        self._actual_sha1 = meta['actual']
+        self._read = read
+
+    @staticmethod
+    def is_compact(data):
+        return data.startswith(COMPACT_MAGIC)
+
+    @property
+    def _diff(self):
+        return dmp_to_mdiff(self._chunks())
+
+    def _chunks(self):
+        """Yield the diff in diff_match_patch format."""
+        left = self._read(self._expected_sha1).splitlines(True)
+        right = self._read(self._actual_sha1).splitlines(True)
+        i = j = 0
+        for opcode in self._opcodes.splitlines():
+            op, count = opcode[0], int(opcode[1:])
+            if op == '=':
+                yield DMP.DIFF_EQUAL, ''.join(left[i:i + count])
+                i += count
+                j += count
+            elif op == '-':
+                yield DMP.DIFF_DELETE, ''.join(left[i:i + count])
+                i += count
+            else:
+                yield DMP.DIFF_INSERT, ''.join(right[j:j + count])
+                j += count
+
+    def outputs_match(self):
+        return False
 
 
 def esc(string):
@@ -1,7 +1,6 @@
 import dateutil.parser
 import json
 import ldap
-import pickle
 import pika
 import re
 import traceback
@@ -17,6 +16,7 @@ from pyramid.settings import asbool
 from sqlalchemy.exc import IntegrityError
 from tempfile import NamedTemporaryFile
 from zipfile import ZipFile
+from . import legacy_pickle
 from .exceptions import InvalidId
 
 
@@ -343,26 +343,38 @@ def get_queue_func(request):
 
 
 def prev_next_submission(submission):
-    """Return adjacent sumbission objects for the given submission."""
-    return (Submission.earlier_submission_for_group(submission),
-            Submission.later_submission_for_group(submission))
+    """Return the ids of the adjacent submissions for the given submission."""
+    return Submission.adjacent_ids(submission)
 
 
 def prev_next_group(project, group):
     """Return adjacent group objects or None for the given project and group.
 
     The previous and next group objects are relative to sort order of the
-    project's groups with respect to the passed in group.
+    project's groups with respect to the passed in group. Only groups with
+    submissions are included, and they are ordered (see `Group.__lt__`) using
+    a single query rather than by loading every group and its users.
 
     """
-    # TODO: Profile and optimize this query if necessary
-    groups = sorted(x for x in project.groups if x.submissions)
+    with_submissions = (Session.query(Submission.group_id)
+                        .filter(Submission.project_id == project.id))
+    first_user = {}
+    for group_id, user in (Session.query(UserToGroup.group_id, User)
+                           .filter(User.id == UserToGroup.user_id)
+                           .filter(UserToGroup.project_id == project.id)
+                           .filter(UserToGroup.group_id.in_(
+                               with_submissions))):
+        if group_id not in first_user or user < first_user[group_id]:
+            first_user[group_id] = user
+    group_ids = sorted(first_user, key=first_user.get)
     try:
-        index = groups.index(group)
+        index = group_ids.index(group.id)
     except ValueError:
         return None, None
-    prev_group = groups[index - 1] if index > 0 else None
-    next_group = groups[index + 1] if index + 1 < len(groups) else None
+    prev_group = Group.fetch_by_id(group_ids[index - 1]) if index > 0 \
+        else None
+    next_group = Group.fetch_by_id(group_ids[index + 1]) \
+        if index + 1 < len(group_ids) else None
     return prev_group, next_group
 
 
@@ -431,10 +443,36 @@ def test_case_verification(function):
     return wrapped
 
 
+def materialize_diff(test_case_result, file_directory):
+    """Make and store the diff of a result whose diff was deferred.
+
+    The diff of an identical pair of outputs is reused when available.
+
+    """
+    expected_sha1 = test_case_result.test_case.expected.sha1
+    actual_sha1 = test_case_result.output.sha1
+    cached = DiffCache.fetch(expected_sha1, actual_sha1)
+    if cached:
+        test_case_result.diff = cached.diff
+        return
+    with open(File.file_path(file_directory, expected_sha1)) as fp:
+        expected_output = fp.read()
+    with open(File.file_path(file_directory, actual_sha1)) as fp:
+        actual_output = fp.read()
+    diff = File.fetch_or_create(
+        Diff(expected_output, actual_output).serialize(expected_sha1,
+                                                       actual_sha1),
+        file_directory)
+    DiffCache.store(expected_sha1, actual_sha1, diff)
+    test_case_result.diff = diff
+
+
 def prepare_renderable(request, test_case_result, is_admin):
     """Return a completed Renderable."""
     test_case = test_case_result.test_case
     file_directory = request.registry.settings['file_directory']
+    if test_case.output_type == 'diff' and test_case_result.diff_pending:
+        materialize_diff(test_case_result, file_directory)
     sha1 = test_case_result.diff.sha1 if test_case_result.diff else None
     kwargs = {'number': test_case.id, 'group': test_case.testable.name,
               'name': test_case.name, 'points': test_case.points,
@@ -454,9 +492,16 @@ def prepare_renderable(request, test_case_result, is_admin):
     elif not test_case_result.diff:  # Outputs match
         return DiffWithMetadata(diff=None, **kwargs)
 
-    try:
+    def read(sha1):
         with open(File.file_path(file_directory, sha1)) as fp:
-            diff = pickle.load(fp)
+            return fp.read()
+
+    try:
+        data = read(sha1)
+        if LazyDiff.is_compact(data):
+            diff = LazyDiff(data, read)
+        else:  # Diffs stored before the compact format
+            diff = legacy_pickle.loads(data)
     except (AttributeError, EOFError):
         content = 'submit system mismatch -- requeue submission'
         content += traceback.format_exc(1)
@@ -467,7 +512,7 @@ def prepare_renderable(request, test_case_result, is_admin):
         return TextOutput(content=content, **kwargs)
 
     diff.hide_expected = not is_admin and test_case.hide_expected
-    return DiffWithMetadata(diff=diff, **kwargs)
+    return DiffWithMetadata(diff=diff, sha1=sha1, **kwargs)
 
 
 def zip_response(request, filename, files):
@@ -523,6 +568,7 @@ def zip_response_adv(request, filename, files):
         tmp_file.close() 
 
 # Avoid cyclic import
-from .diff_unit import DiffWithMetadata, ImageOutput, TextOutput
-from .models import (BuildFile, File, FileVerifier, PasswordReset, Session,
-                     Submission, User)
+from .diff_unit import (Diff, DiffWithMetadata, ImageOutput, LazyDiff,
+                        TextOutput)
+from .models import (BuildFile, DiffCache, File, FileVerifier, Group,
+                     PasswordReset, Session, Submission, User, UserToGroup)
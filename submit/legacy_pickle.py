@@ -0,0 +1,29 @@
+"""Load pickles written before the package was renamed from nudibranch.
+
+The module provides `dumps` and `loads` and can thus be used as the pickler of
+a PickleType column.
+
+"""
+import sys
+from cPickle import HIGHEST_PROTOCOL, Unpickler, dumps
+from cStringIO import StringIO
+
+__all__ = ['HIGHEST_PROTOCOL', 'dumps', 'load', 'loads']
+
+
+def find_global(module, name):
+    """Return the named class, looking up nudibranch modules in submit."""
+    if module == 'nudibranch' or module.startswith('nudibranch.'):
+        module = 'submit' + module[len('nudibranch'):]
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def load(fp):
+    unpickler = Unpickler(fp)
+    unpickler.find_global = find_global
+    return unpickler.load()
+
+
+def loads(data):
+    return load(StringIO(data))
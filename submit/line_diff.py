@@ -0,0 +1,165 @@
+"""A line diff designed for comparing program outputs.
+
+The common prefix and suffix of the outputs are trimmed and the remaining
+lines are compared with the linear space variant of Myers' O(ND) algorithm
+("An O(ND) Difference Algorithm and Its Variations", 1986). The search is
+abandoned once more lines differ than can be shown (see `MAX_DIFF_LINES`),
+bounding the time spent on unrelated outputs to O((N + M) * MAX_DIFF_LINES).
+
+"""
+from diff_match_patch import diff_match_patch as DMP
+from .diff_render import MAX_DIFF_LINES
+
+# A row of the rendered diff pairs a deleted line with an inserted line
+MAX_EDITS = 2 * MAX_DIFF_LINES
+
+
+def line_diff(correct, given, max_edits=MAX_EDITS):
+    """Return the diff of the outputs in diff_match_patch format.
+
+    The diff is a list of (op, text) tuples where text consists of entire
+    lines (as split by `splitlines`). When more than `max_edits` lines need
+    to be deleted or inserted, all the lines between the common prefix and
+    suffix are marked as changed.
+
+    """
+    left = correct.splitlines(True)
+    right = given.splitlines(True)
+    # Compare small integers rather than lines
+    ids = {}
+    a = [ids.setdefault(x, len(ids)) for x in left]
+    b = [ids.setdefault(x, len(ids)) for x in right]
+
+    ops = []
+    if not _diff(a, 0, len(a), b, 0, len(b), ops, max_edits):
+        ops = []
+        _coarse(a, 0, len(a), b, 0, len(b), ops)
+
+    diffs = []
+    i = j = 0
+    for op, count in ops:
+        if op == DMP.DIFF_INSERT:
+            text = ''.join(right[j:j + count])
+            j += count
+        else:
+            text = ''.join(left[i:i + count])
+            i += count
+            if op == DMP.DIFF_EQUAL:
+                j += count
+        if diffs and diffs[-1][0] == op:
+            diffs[-1] = op, diffs[-1][1] + text
+        else:
+            diffs.append((op, text))
+    return diffs
+
+
+def _add(ops, op, count):
+    if count:
+        ops.append((op, count))
+
+
+def _coarse(a, a0, a1, b, b0, b1, ops):
+    """Mark every line between the common prefix and suffix as changed."""
+    prefix, suffix = _trim(a, a0, a1, b, b0, b1)
+    _add(ops, DMP.DIFF_EQUAL, prefix)
+    _add(ops, DMP.DIFF_DELETE, a1 - a0 - prefix - suffix)
+    _add(ops, DMP.DIFF_INSERT, b1 - b0 - prefix - suffix)
+    _add(ops, DMP.DIFF_EQUAL, suffix)
+
+
+def _trim(a, a0, a1, b, b0, b1):
+    """Return the lengths of the common prefix and suffix."""
+    prefix = 0
+    while a0 + prefix < a1 and b0 + prefix < b1 and \
+            a[a0 + prefix] == b[b0 + prefix]:
+        prefix += 1
+    suffix = 0
+    while a0 + prefix < a1 - suffix and b0 + prefix < b1 - suffix and \
+            a[a1 - suffix - 1] == b[b1 - suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+
+def _diff(a, a0, a1, b, b0, b1, ops, max_edits):
+    """Append the operations transforming a[a0:a1] into b[b0:b1] to `ops`.
+
+    Return False when more than `max_edits` edits are required.
+
+    """
+    prefix, suffix = _trim(a, a0, a1, b, b0, b1)
+    _add(ops, DMP.DIFF_EQUAL, prefix)
+    a0 += prefix
+    b0 += prefix
+    a1 -= suffix
+    b1 -= suffix
+    if a0 == a1 or b0 == b1:
+        if a1 - a0 + b1 - b0 > max_edits:
+            return False
+        _add(ops, DMP.DIFF_DELETE, a1 - a0)
+        _add(ops, DMP.DIFF_INSERT, b1 - b0)
+    else:
+        snake = _middle_snake(a, a0, a1, b, b0, b1, max_edits)
+        if snake is None:
+            return False
+        x, y, u, v = snake
+        if (u, v) == (a0, b0) or (x, y) == (a1, b1):  # Cannot split further
+            _coarse(a, a0, a1, b, b0, b1, ops)
+        else:
+            if not _diff(a, a0, x, b, b0, y, ops, max_edits):
+                return False
+            _add(ops, DMP.DIFF_EQUAL, u - x)
+            if not _diff(a, u, a1, b, v, b1, ops, max_edits):
+                return False
+    _add(ops, DMP.DIFF_EQUAL, suffix)
+    return True
+
+
+def _middle_snake(a, a0, a1, b, b0, b1, max_edits):
+    """Return (x, y, u, v), the middle snake of an optimal path.
+
+    The snake runs from (x, y) to (u, v) in the coordinates of `a` and `b`.
+    Return None when more than `max_edits` edits are required.
+
+    """
+    n = a1 - a0
+    m = b1 - b0
+    delta = n - m
+    odd = delta % 2
+    max_d = min((n + m + 1) // 2, (max_edits + 1) // 2)
+    offset = max_d + 1
+    # The furthest x reached on each diagonal k = x - y, forwards from the
+    # start and backwards from the end
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or k != d and \
+                    forward[offset + k - 1] < forward[offset + k + 1]:
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            start = x
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and delta - d < k < delta + d and \
+                    x + backward[offset + delta - k] >= n:
+                return (a0 + start, b0 + start - k, a0 + x, b0 + y)
+        for k in range(-d, d + 1, 2):
+            if k == -d or k != d and \
+                    backward[offset + k - 1] < backward[offset + k + 1]:
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            start = x
+            y = x - k
+            while x < n and y < m and a[a1 - x - 1] == b[b1 - y - 1]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + forward[offset + delta - k] >= n:
+                return (a1 - x, b1 - y, a1 - start, b1 - start + k)
+    return None
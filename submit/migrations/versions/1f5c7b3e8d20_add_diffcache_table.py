@@ -0,0 +1,29 @@
+"""Add DiffCache table.
+
+Revision ID: 1f5c7b3e8d20
+Revises: 52d6e0a9b7c1
+Create Date: 2026-10-18 13:41:52.610893
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f5c7b3e8d20'
+down_revision = '52d6e0a9b7c1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('diffcache',
+    sa.Column('actual_sha1', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('diff_id', sa.Integer(), nullable=False),
+    sa.Column('expected_sha1', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['diff_id'], [u'file.id'], ),
+    sa.PrimaryKeyConstraint('actual_sha1', 'expected_sha1')
+    )
+
+
+def downgrade():
+    op.drop_table('diffcache')
@@ -0,0 +1,30 @@
+"""Add input_digest to TestableResult and nondeterministic to TestCase.
+
+Revision ID: 3b1f0c9d2e4a
+Revises: 4ae1e9a2ff2
+Create Date: 2026-10-18 09:12:44.503117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c9d2e4a'
+down_revision = '4ae1e9a2ff2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testcase', sa.Column('nondeterministic', sa.Boolean(),
+                                        server_default=u'0', nullable=False))
+    op.add_column('testableresult', sa.Column('input_digest', sa.String(),
+                                              nullable=True))
+    op.create_index('ix_testableresult_input_digest', 'testableresult',
+                    ['input_digest'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_testableresult_input_digest',
+                  table_name='testableresult')
+    op.drop_column('testableresult', 'input_digest')
+    op.drop_column('testcase', 'nondeterministic')
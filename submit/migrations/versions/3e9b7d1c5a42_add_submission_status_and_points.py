@@ -0,0 +1,111 @@
+"""Add status, points and results_at to submission.
+
+Revision ID: 3e9b7d1c5a42
+Revises: 8a4d2c6e1f05
+Create Date: 2026-10-18 19:04:51.207316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e9b7d1c5a42'
+down_revision = '8a4d2c6e1f05'
+
+from alembic import op
+from sqlalchemy.sql import bindparam, column, table
+from submit import legacy_pickle
+import sqlalchemy as sa
+
+status_type = sa.Enum(u'unverified', u'pending', u'complete',
+                      name=u'submission_status')
+
+submission = table('submission',
+                   column('id', sa.Integer),
+                   column('hidden_points', sa.Integer),
+                   column('project_id', sa.Integer),
+                   column('results_at', sa.DateTime(timezone=True)),
+                   column('status', status_type),
+                   column('verification_results',
+                          sa.PickleType(pickler=legacy_pickle)),
+                   column('verified_at', sa.DateTime(timezone=True)),
+                   column('visible_points', sa.Integer))
+
+testable = table('testable',
+                 column('id', sa.Integer),
+                 column('is_hidden', sa.Boolean),
+                 column('project_id', sa.Integer))
+
+testableresult = table('testableresult',
+                       column('created_at', sa.DateTime(timezone=True)),
+                       column('points', sa.Integer),
+                       column('submission_id', sa.Integer),
+                       column('testable_id', sa.Integer))
+
+
+def upgrade():
+    status_type.create(op.get_bind(), checkfirst=False)
+    op.add_column('submission', sa.Column('hidden_points', sa.Integer(),
+                                          server_default=u'0',
+                                          nullable=False))
+    op.add_column('submission', sa.Column('results_at',
+                                          sa.DateTime(timezone=True),
+                                          nullable=True))
+    op.add_column('submission', sa.Column('status', status_type,
+                                          server_default=u'unverified',
+                                          nullable=False))
+    op.add_column('submission', sa.Column('visible_points', sa.Integer(),
+                                          server_default=u'0',
+                                          nullable=False))
+
+    # Set the columns of the verified submissions (see
+    # Submission.refresh_score)
+    conn = op.get_bind()
+    testables = {}
+    hidden = set()
+    for testable_id, is_hidden, project_id in conn.execute(testable.select()):
+        testables.setdefault(project_id, set()).add(testable_id)
+        if is_hidden:
+            hidden.add(testable_id)
+    results = {}
+    for created_at, points, submission_id, testable_id in \
+            conn.execute(testableresult.select()):
+        results.setdefault(submission_id, []).append(
+            (testable_id, points, created_at))
+
+    updates = []
+    for submission_id, project_id, verification_results, verified_at in \
+            conn.execute(sa.select([submission.c.id, submission.c.project_id,
+                                    submission.c.verification_results,
+                                    submission.c.verified_at])
+                         .where(submission.c.verification_results != None)):  # NOQA
+        done = verification_results.missing_testable_ids()
+        data = {'hidden_points': 0, 'results_at': None, 'status': u'pending',
+                'submission_id': submission_id, 'visible_points': 0}
+        finished = [verified_at]
+        for testable_id, points, created_at in results.get(submission_id, []):
+            done.add(testable_id)
+            finished.append(created_at)
+            if testable_id in hidden:
+                data['hidden_points'] += points
+            else:
+                data['visible_points'] += points
+        if not testables.get(project_id, set()) - done:
+            data['status'] = u'complete'
+            finished = [x for x in finished if x]
+            data['results_at'] = max(finished) if finished else None
+        updates.append(data)
+    if updates:
+        conn.execute(submission.update()
+                     .where(submission.c.id == bindparam('submission_id'))
+                     .values(hidden_points=bindparam('hidden_points'),
+                             results_at=bindparam('results_at'),
+                             status=bindparam('status'),
+                             visible_points=bindparam('visible_points')),
+                     updates)
+
+
+def downgrade():
+    op.drop_column('submission', 'visible_points')
+    op.drop_column('submission', 'status')
+    op.drop_column('submission', 'results_at')
+    op.drop_column('submission', 'hidden_points')
+    status_type.drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,32 @@
+"""Add resource usage to TestCaseResult.
+
+Revision ID: 52d6e0a9b7c1
+Revises: 3b1f0c9d2e4a
+Create Date: 2026-10-18 11:02:17.284301
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52d6e0a9b7c1'
+down_revision = '3b1f0c9d2e4a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testcaseresult', sa.Column('cpu_sys', sa.Float(),
+                                              nullable=True))
+    op.add_column('testcaseresult', sa.Column('cpu_user', sa.Float(),
+                                              nullable=True))
+    op.add_column('testcaseresult', sa.Column('max_rss', sa.Integer(),
+                                              nullable=True))
+    op.add_column('testcaseresult', sa.Column('wall_time', sa.Float(),
+                                              nullable=True))
+
+
+def downgrade():
+    op.drop_column('testcaseresult', 'wall_time')
+    op.drop_column('testcaseresult', 'max_rss')
+    op.drop_column('testcaseresult', 'cpu_user')
+    op.drop_column('testcaseresult', 'cpu_sys')
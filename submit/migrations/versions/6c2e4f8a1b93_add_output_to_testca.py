@@ -0,0 +1,29 @@
+"""Add output and output_matches to TestCaseResult.
+
+Revision ID: 6c2e4f8a1b93
+Revises: 1f5c7b3e8d20
+Create Date: 2026-10-18 15:06:33.918204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c2e4f8a1b93'
+down_revision = '1f5c7b3e8d20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testcaseresult', sa.Column('output_id', sa.Integer(),
+                                              nullable=True))
+    op.create_foreign_key(u'testcaseresult_output_id_fkey', u'testcaseresult',
+                          u'file', [u'output_id'], [u'id'])
+    op.add_column('testcaseresult', sa.Column('output_matches', sa.Boolean(),
+                                              nullable=True))
+
+
+def downgrade():
+    op.drop_column('testcaseresult', 'output_matches')
+    op.drop_constraint(u'testcaseresult_output_id_fkey', u'testcaseresult')
+    op.drop_column('testcaseresult', 'output_id')
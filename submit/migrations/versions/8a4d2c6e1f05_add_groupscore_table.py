@@ -0,0 +1,122 @@
+"""Add GroupScore table.
+
+Revision ID: 8a4d2c6e1f05
+Revises: 6c2e4f8a1b93
+Create Date: 2026-10-18 17:22:09.381527
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a4d2c6e1f05'
+down_revision = '6c2e4f8a1b93'
+
+from alembic import op
+from sqlalchemy.sql import column, func, table
+import sqlalchemy as sa
+
+groupscore = table('groupscore',
+                   column('best_id', sa.Integer),
+                   column('best_ontime_id', sa.Integer),
+                   column('best_ontime_points', sa.Integer),
+                   column('best_points', sa.Integer),
+                   column('group_id', sa.Integer),
+                   column('project_id', sa.Integer),
+                   column('submissions', sa.Integer))
+
+project = table('project',
+                column('id', sa.Integer),
+                column('class_id', sa.Integer),
+                column('deadline', sa.DateTime(timezone=True)))
+
+submission = table('submission',
+                   column('id', sa.Integer),
+                   column('created_at', sa.DateTime(timezone=True)),
+                   column('group_id', sa.Integer),
+                   column('project_id', sa.Integer))
+
+testableresult = table('testableresult',
+                       column('points', sa.Integer),
+                       column('submission_id', sa.Integer))
+
+user_to_class_admin = table('user_to_class_admin',
+                            column('class_id', sa.Integer),
+                            column('user_id', sa.Integer))
+
+user_to_group = table('user_to_group',
+                      column('group_id', sa.Integer),
+                      column('project_id', sa.Integer),
+                      column('user_id', sa.Integer))
+
+
+def upgrade():
+    op.create_table(
+        'groupscore',
+        sa.Column('best_id', sa.Integer(), nullable=False),
+        sa.Column('best_ontime_id', sa.Integer(), nullable=True),
+        sa.Column('best_ontime_points', sa.Integer(), nullable=True),
+        sa.Column('best_points', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('submissions', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['best_id'], [u'submission.id'], ),
+        sa.ForeignKeyConstraint(['best_ontime_id'], [u'submission.id'], ),
+        sa.ForeignKeyConstraint(['group_id'], [u'group.id'], ),
+        sa.ForeignKeyConstraint(['project_id'], [u'project.id'], ),
+        sa.PrimaryKeyConstraint('group_id')
+    )
+    op.create_index('ix_groupscore_project_id', 'groupscore', ['project_id'])
+
+    # Score the existing submissions (see GroupScore.refresh_project)
+    conn = op.get_bind()
+    admins = {}
+    for class_id, user_id in conn.execute(user_to_class_admin.select()):
+        admins.setdefault(class_id, set()).add(user_id)
+    projects = {}
+    for project_id, class_id, deadline in conn.execute(project.select()):
+        projects[project_id] = admins.get(class_id, set()), deadline
+    with_admins = set()
+    for group_id, project_id, user_id in conn.execute(
+            sa.select([user_to_group.c.group_id, user_to_group.c.project_id,
+                       user_to_group.c.user_id])):
+        if user_id in projects[project_id][0]:
+            with_admins.add(group_id)
+
+    scores = {}
+    for submission_id, created_at, group_id, project_id, points in \
+            conn.execute(
+                sa.select([submission.c.id, submission.c.created_at,
+                           submission.c.group_id, submission.c.project_id,
+                           func.coalesce(func.sum(testableresult.c.points),
+                                         0)])
+                .select_from(submission.outerjoin(
+                    testableresult,
+                    testableresult.c.submission_id == submission.c.id))
+                .group_by(submission.c.id, submission.c.created_at,
+                          submission.c.group_id, submission.c.project_id)
+                .order_by(submission.c.created_at, submission.c.id)):
+        if group_id in with_admins:
+            continue
+        points = int(points)
+        score = scores.setdefault(group_id, {
+            'best_id': None, 'best_ontime_id': None,
+            'best_ontime_points': None, 'best_points': None,
+            'group_id': group_id, 'project_id': project_id,
+            'submissions': 0})
+        score['submissions'] += 1
+        if score['best_id'] is None or points > score['best_points']:
+            score['best_id'] = submission_id
+            score['best_points'] = points
+        deadline = projects[project_id][1]
+        if deadline and created_at >= deadline:
+            continue
+        if score['best_ontime_id'] is None or \
+                points > score['best_ontime_points']:
+            score['best_ontime_id'] = submission_id
+            score['best_ontime_points'] = points
+    if scores:
+        op.bulk_insert(groupscore, list(scores.values()))
+
+
+def downgrade():
+    op.drop_index('ix_groupscore_project_id', 'groupscore')
+    op.drop_table('groupscore')
@@ -10,14 +10,17 @@ from datetime import datetime, timedelta
 from hashlib import sha1
 from pyramid_addons.helpers import UTC
 from sqla_mixins import BasicBase, UserMixin
-from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, ForeignKey,
-                        Integer, PickleType, String, Table, Unicode,
-                        UnicodeText, and_, func)
+from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, Float,
+                        ForeignKey, Integer, PickleType, String, Table,
+                        Unicode, UnicodeText, and_, func, or_)
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import (backref, defer, relationship, scoped_session,
+                            sessionmaker, subqueryload, subqueryload_all,
+                            undefer)
 from sqlalchemy.schema import UniqueConstraint
 from zope.sqlalchemy import ZopeTransactionExtension
+from . import legacy_pickle
 from .exceptions import GroupWithException
 from .helpers import alphanum_key
 
@@ -26,6 +29,9 @@ if sys.version_info < (3, 0):
 else:
     import builtins
 
+# Bump when a change to the workers can alter the result of identical inputs
+RESULT_DIGEST_VERSION = 1
+
 Base = declarative_base()
 Session = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 # Make Session available to sqla_mixins
@@ -121,6 +127,38 @@ class Class(BasicBase, Base):
         return user.is_admin or self in user.admin_for
 
 
+class DiffCache(Base):
+    """The stored diff of an actual output against an expected output.
+
+    Many submissions produce the same incorrect output, so each pair of
+    outputs (identified by their sha1sums) is only diffed once.
+
+    """
+    __tablename__ = 'diffcache'
+    actual_sha1 = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), default=func.now(),
+                        nullable=False)
+    diff = relationship('File')
+    diff_id = Column(Integer, ForeignKey('file.id'), nullable=False)
+    expected_sha1 = Column(String, primary_key=True)
+
+    @classmethod
+    def fetch(cls, expected_sha1, actual_sha1):
+        return Session.query(cls).filter_by(
+            actual_sha1=actual_sha1, expected_sha1=expected_sha1).first()
+
+    @classmethod
+    def store(cls, expected_sha1, actual_sha1, diff):
+        """Cache the diff unless a concurrent job already has."""
+        sp = transaction.savepoint()
+        try:
+            Session.add(cls(actual_sha1=actual_sha1, diff=diff,
+                            expected_sha1=expected_sha1))
+            Session.flush()
+        except IntegrityError:
+            sp.rollback()
+
+
 class ExecutionFile(BasicBase, Base):
     __table_args__ = (UniqueConstraint('filename', 'project_id'),)
     file = relationship('File', backref='execution_files')
@@ -213,6 +251,10 @@ class File(BasicBase, Base):
                           in self.test_case_result_for)
             if classes.intersection(user.admin_for):
                 return True
+            classes = set(x.test_case.testable.project.class_ for x
+                          in self.test_case_output_for)
+            if classes.intersection(user.admin_for):
+                return True
         return False
 
 
@@ -314,6 +356,121 @@ class GroupRequest(BasicBase, Base):
         return user == self.to_user
 
 
+class GroupScore(Base):
+    """The best scores of a group's submissions to its project.
+
+    `best` is the earliest of the group's submissions with the most points
+    (hidden test groups included) and `best_ontime` is the same among those
+    made before the deadline. Groups with a class admin are not scored.
+
+    The scores are refreshed whenever they may change: when results are
+    stored or verified, when points are recomputed and when the group, the
+    class admins or the deadline change. The project summary and the score
+    export then read a single row per group.
+
+    """
+    __tablename__ = 'groupscore'
+    best = relationship('Submission', foreign_keys='GroupScore.best_id')
+    best_id = Column(Integer, ForeignKey('submission.id'), nullable=False)
+    best_ontime = relationship('Submission',
+                               foreign_keys='GroupScore.best_ontime_id')
+    best_ontime_id = Column(Integer, ForeignKey('submission.id'),
+                            nullable=True)
+    best_ontime_points = Column(Integer, nullable=True)
+    best_points = Column(Integer, nullable=False)
+    group = relationship(Group, backref=backref(
+        'score', cascade='all, delete-orphan', uselist=False))
+    group_id = Column(Integer, ForeignKey('group.id'), primary_key=True)
+    project = relationship('Project', backref=backref(
+        'group_scores', cascade='all, delete-orphan'))
+    project_id = Column(Integer, ForeignKey('project.id'), index=True,
+                        nullable=False)
+    submissions = Column(Integer, nullable=False)
+
+    @classmethod
+    def fetch_for_project(cls, project):
+        """Return the project's scores along with their groups' users."""
+        return (Session.query(cls).filter(cls.project_id == project.id)
+                .options(subqueryload_all(cls.group, Group.group_assocs,
+                                          UserToGroup.user)).all())
+
+    @classmethod
+    def refresh(cls, group):
+        """Recompute the scores of a single group.
+
+        The group's row is locked first so that the refreshes of concurrent
+        jobs for the group's submissions see each other's results.
+
+        """
+        Session.flush()  # The group may be new
+        (Session.query(Group.id).filter(Group.id == group.id)
+         .with_for_update().one())
+        cls.refresh_project(group.project, group_ids=[group.id])
+
+    @classmethod
+    def refresh_project(cls, project, group_ids=None):
+        """Recompute the scores of the project's groups (or of `group_ids`).
+
+        The points stored with each submission (see `Submission.refresh_score`)
+        are read in a single query.
+
+        """
+        admin_ids = set(x.id for x in project.class_.admins)
+        members = (Session.query(UserToGroup.group_id, UserToGroup.user_id)
+                   .filter(UserToGroup.project_id == project.id))
+        points = (Session.query(Submission.group_id, Submission.id,
+                                Submission.created_at,
+                                Submission.visible_points +
+                                Submission.hidden_points)
+                  .filter(Submission.project_id == project.id)
+                  .order_by(Submission.created_at, Submission.id))
+        existing = Session.query(cls).filter(cls.project_id == project.id)
+        if group_ids is not None:
+            members = members.filter(UserToGroup.group_id.in_(group_ids))
+            points = points.filter(Submission.group_id.in_(group_ids))
+            existing = existing.filter(cls.group_id.in_(group_ids))
+
+        with_admins = set(x for (x, y) in members if y in admin_ids)
+        scores = {}
+        for group_id, submission_id, created_at, total in points:
+            if group_id in with_admins:
+                continue
+            score = scores.setdefault(group_id, {
+                'best_id': None, 'best_ontime_id': None,
+                'best_ontime_points': None, 'best_points': None,
+                'submissions': 0})
+            score['submissions'] += 1
+            if score['best_id'] is None or total > score['best_points']:
+                score['best_id'] = submission_id
+                score['best_points'] = total
+            if project.deadline and created_at >= project.deadline:
+                continue
+            if score['best_ontime_id'] is None or \
+                    total > score['best_ontime_points']:
+                score['best_ontime_id'] = submission_id
+                score['best_ontime_points'] = total
+
+        for group_score in existing:
+            data = scores.pop(group_score.group_id, None)
+            if data:
+                for attr, val in data.items():
+                    setattr(group_score, attr, val)
+            else:
+                Session.delete(group_score)
+        for group_id, data in scores.items():
+            sp = transaction.savepoint()
+            try:
+                Session.add(cls(group_id=group_id, project_id=project.id,
+                                **data))
+                Session.flush()
+            except IntegrityError:  # A concurrent refresh scored it first
+                sp.rollback()
+                group_score = (Session.query(cls)
+                               .filter(cls.group_id == group_id).one())
+                for attr, val in data.items():
+                    setattr(group_score, attr, val)
+
+
 class VerificationResults(object):
 
     """Stores verification information about a single submission.
@@ -345,12 +502,19 @@ class VerificationResults(object):
         import pprint
         return pprint.pformat(vars(self))
 
-    def missing_testables(self):
-        """Return a set of testables that have files missing."""
+    def missing_testable_ids(self):
+        """Return the set of ids of testables that have files missing."""
         ids = set()
         for id_set in self._missing_to_testable_ids.values():
             ids |= id_set
-        return set(x for x in (Testable.fetch_by_id(y) for y in ids) if x)
+        return ids
+
+    def missing_testables(self):
+        """Return a set of testables that have files missing."""
+        ids = self.missing_testable_ids()
+        if not ids:
+            return set()
+        return set(Testable.query_by().filter(Testable.id.in_(ids)).all())
 
     def set_errors_for_filename(self, errors, filename):
         self._errors_by_filename[filename] = errors
@@ -422,11 +586,6 @@ class Project(BasicBase, Base):
     def is_ready(self):
         return self.status == 'ready'
 
-    @property
-    def student_submissions(self):
-        admins = set(self.class_.admins)
-        return [x for x in self.submissions if not set(x.group.users) & admins]
-
     def __cmp__(self, other):
         return cmp(alphanum_key(self.name), alphanum_key(other.name))
 
@@ -462,29 +621,6 @@ class Project(BasicBase, Base):
                     for test_case in testable.test_cases
                     if include_hidden or not testable.is_hidden])
 
-    def process_submissions(self):
-        by_group = {}
-        best_ontime = {}
-        best = {}
-        admins = set(self.class_.admins)
-        for sub in sorted(self.submissions, key=lambda x: x.created_at):
-            is_student = not set(sub.group.users) & admins
-            points = sub.points(include_hidden=True)
-            if sub.group in by_group:
-                by_group[sub.group].append(sub)
-                if is_student:
-                    if points > best[sub.group][1]:
-                        best[sub.group] = sub, points
-                    if not sub.is_late and points > best_ontime[sub.group][1]:
-                        best_ontime[sub.group] = sub, points
-            else:
-                by_group[sub.group] = [sub]
-                if is_student:
-                    best[sub.group] = sub, points
-                    if not sub.is_late:
-                        best_ontime[sub.group] = sub, points
-        return by_group, best_ontime, best
-
     def recent_submissions(self):
         """Generate a list of the most recent submissions for each user.
 
@@ -557,6 +693,8 @@ class Project(BasicBase, Base):
             # Set new information
             submission.verification_results = results
             submission.verified_at = func.now()
+            submission.refresh_score()
+            GroupScore.refresh(submission.group)
         return retval
 
 
@@ -567,13 +705,22 @@ class Submission(BasicBase, Base):
     group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
     files = relationship('SubmissionToFile', backref='submission',
                          cascade='all, delete-orphan')
+    hidden_points = Column(Integer, nullable=False, default=0,
+                           server_default='0')
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
+    results_at = Column(DateTime(timezone=True), nullable=True)
+    status = Column(Enum('unverified', 'pending', 'complete',
+                         name='submission_status'),
+                    nullable=False, default='unverified',
+                    server_default='unverified')
     test_case_results = relationship('TestCaseResult', backref='submission',
                                      cascade='all, delete-orphan')
     testable_results = relationship('TestableResult', backref='submission',
                                     cascade='all, delete-orphan')
-    verification_results = Column(PickleType)
+    verification_results = Column(PickleType(pickler=legacy_pickle))
     verified_at = Column(DateTime(timezone=True), index=True)
+    visible_points = Column(Integer, nullable=False, default=0,
+                            server_default='0')
 
     @property
     def is_late(self):
@@ -581,20 +728,22 @@ class Submission(BasicBase, Base):
             and self.created_at >= self.project.deadline
 
     @staticmethod
-    def earlier_submission_for_group(submission):
-        """Return the submission immediately prior to the given submission."""
-        return (Submission
-                .query_by(project=submission.project, group=submission.group)
-                .filter(Submission.created_at < submission.created_at)
-                .order_by(Submission.created_at.desc()).first())
+    def adjacent_ids(submission):
+        """Return the ids of the group's prior and later submissions.
 
-    @staticmethod
-    def later_submission_for_group(submission):
-        """Return the submission immediately prior to the given submission."""
-        return (Submission
-                .query_by(project=submission.project, group=submission.group)
-                .filter(Submission.created_at > submission.created_at)
-                .order_by(Submission.created_at).first())
+        Either id is None when there is no such submission. Both are fetched
+        with a single query.
+
+        """
+        query = (Session.query(Submission.id)
+                 .filter(Submission.project_id == submission.project_id)
+                 .filter(Submission.group_id == submission.group_id))
+        prev_id = (query.filter(Submission.created_at < submission.created_at)
+                   .order_by(Submission.created_at.desc()).limit(1)
+                   .as_scalar())
+        next_id = (query.filter(Submission.created_at > submission.created_at)
+                   .order_by(Submission.created_at).limit(1).as_scalar())
+        return Session.query(prev_id, next_id).one()
 
     @staticmethod
     def merge_dict(d1, d2, on_collision):
@@ -609,6 +758,20 @@ class Submission(BasicBase, Base):
                 retval[key] = d2[key]
         return retval
 
+    @staticmethod
+    def most_recent_by_group(project, count, extra_ids=None):
+        """Return the `count` most recent submissions of each of the
+        project's groups, and those in `extra_ids`, using a single query."""
+        rank = func.row_number().over(partition_by=Submission.group_id,
+                                      order_by=Submission.created_at.desc())
+        ranked = (Session.query(Submission.id, rank.label('rank'))
+                  .filter(Submission.project_id == project.id).subquery())
+        condition = Submission.id.in_(
+            Session.query(ranked.c.id).filter(ranked.c.rank <= count))
+        if extra_ids:
+            condition = or_(condition, Submission.id.in_(extra_ids))
+        return Submission.query_with_scores().filter(condition).all()
+
     @staticmethod
     def most_recent_submission(project, group):
         """Return the most recent submission for the user and project id."""
@@ -626,10 +789,39 @@ class Submission(BasicBase, Base):
         """Return whether or not `user` can view the submission."""
         return user in self.group.users or self.project.can_view(user)
 
+    @classmethod
+    def query_with_scores(cls, **kwargs):
+        """Return a query_by query that also loads what `time_score` uses.
+
+        Otherwise listing submissions lazily loads the group's users of each
+        one. The pickled verification results are only loaded when accessed.
+
+        """
+        return cls.query_by(**kwargs).options(
+            defer(cls.verification_results),
+            subqueryload_all(cls.group, Group.group_assocs, UserToGroup.user))
+
     def file_mapping(self):
         """Return a mapping of filename to File object for the submission."""
         return {x.filename: x.file for x in self.files}
 
+    def load_results(self):
+        """Load everything the submission's results page shows.
+
+        A fixed number of queries replaces the lazy loading of each test case
+        result and its diff, test case, testable and submitted file.
+
+        """
+        project_testables = (Submission.project, Project.testables)
+        Submission.query_with_scores(id=self.id).options(
+            undefer(Submission.verification_results),
+            subqueryload(Submission.testable_results),
+            subqueryload_all(*project_testables + (Testable.file_verifiers,)),
+            subqueryload_all(*project_testables + (Testable.test_cases,)),
+            subqueryload_all(Submission.files, SubmissionToFile.file),
+            subqueryload_all(Submission.test_case_results,
+                             TestCaseResult.diff)).one()
+
     def get_delay(self, update):
         """Return the minutes to delay the viewing of submission results.
 
@@ -662,8 +854,85 @@ class Submission(BasicBase, Base):
 
     def points(self, include_hidden=False):
         """Return the number of points awarded to this submission."""
-        return sum(x.points for x in self.testable_results
-                   if include_hidden or not x.testable.is_hidden)
+        if include_hidden:
+            return self.visible_points + self.hidden_points
+        return self.visible_points
+
+    @classmethod
+    def refresh_project_scores(cls, project):
+        """Recompute the status and points of all the project's submissions.
+
+        Used when the project's testables or test cases change. The rows are
+        locked as in `refresh_score`. The points are summed, and complete
+        submissions without a result of a testable added after they were
+        verified become pending, with an UPDATE each. Only the pending
+        submissions, which may now be complete, load their verification
+        results.
+
+        """
+        Session.flush()
+        Session.expire(project, ['testables'])  # A testable may be deleted
+        submissions = cls.query_by(project=project)
+        (submissions.with_entities(cls.id).order_by(cls.id).with_for_update()
+         .all())
+
+        def points(is_hidden):
+            return (Session.query(func.coalesce(func.sum(
+                TestableResult.points), 0)).join(Testable)
+                .filter(TestableResult.submission_id == cls.id)
+                .filter(Testable.is_hidden == is_hidden).as_scalar())
+        submissions.update({cls.hidden_points: points(True),
+                            cls.visible_points: points(False)},
+                           synchronize_session=False)
+        no_result = ~(Session.query(TestableResult)
+                      .filter(TestableResult.submission_id == cls.id)
+                      .filter(TestableResult.testable_id == Testable.id)
+                      .correlate(cls, Testable).exists())
+        added = (Session.query(Testable)
+                 .filter(Testable.project_id == project.id)
+                 .filter(Testable.created_at > cls.verified_at)
+                 .filter(no_result).exists())
+        (submissions.filter(cls.status == 'complete').filter(added)
+         .update({cls.results_at: None, cls.status: 'pending'},
+                 synchronize_session=False))
+        for submission in Session.identity_map.values():
+            if isinstance(submission, cls):
+                Session.expire(submission)
+        for submission in (submissions.filter(cls.status == 'pending')
+                           .options(subqueryload(cls.testable_results))):
+            submission._set_score(submission.testable_results)
+
+    def refresh_score(self):
+        """Recompute the status and points `time_score` shows.
+
+        The submission's row is locked first so that concurrent jobs for its
+        testables see each other's results.
+
+        """
+        Session.flush()
+        (Session.query(Submission.id).filter(Submission.id == self.id)
+         .with_for_update().one())
+        self._set_score(TestableResult.query_by(submission=self).all())
+
+    def _set_score(self, testable_results):
+        if not self.verification_results:
+            status = 'unverified'
+        else:
+            done = (self.verification_results.missing_testable_ids()
+                    | set(x.testable_id for x in testable_results))
+            if any(x.id not in done for x in self.project.testables):
+                status = 'pending'
+            else:
+                status = 'complete'
+        self.hidden_points = sum(x.points for x in testable_results
+                                 if x.testable.is_hidden)
+        self.visible_points = sum(x.points for x in testable_results
+                                  if not x.testable.is_hidden)
+        if status != 'complete':
+            self.results_at = None
+        elif self.status != 'complete':
+            self.results_at = func.now()
+        self.status = status
 
     def testables_pending(self, prune=False):
         """Return the set of testables that _can_ execute and have yet to.
@@ -671,12 +940,10 @@ class Submission(BasicBase, Base):
         If prune is true, filter out hidden testables.
 
         """
-        if prune:
-            tbs = set(x for x in self.project.testables if not x.is_hidden)
-        else:
-            tbs = set(self.project.testables)
-        return (tbs - self.verification_results.missing_testables()
-                - set(x.testable for x in self.testable_results))
+        done = (self.verification_results.missing_testable_ids()
+                | set(x.testable_id for x in self.testable_results))
+        return set(x for x in self.project.testables if x.id not in done
+                   and not (prune and x.is_hidden))
 
     def testables_succeeded(self):
         """Return the testables which have successfully executed."""
@@ -686,9 +953,9 @@ class Submission(BasicBase, Base):
     def time_score(self, request, group=False, admin=False):
         url = request.route_path('submission_item', submission_id=self.id)
         fmt = '<a href="{url}">{created}</a>{name} {score} {modifier}'
-        if not self.verification_results:
+        if self.status == 'unverified':
             score = '<span class="label">waiting to verify submission</span>'
-        elif self.testables_pending():
+        elif self.status == 'pending':
             score = '<span class="label">waiting for results</span>'
         elif not admin and self.get_delay(update=False):
             score = '<span class="label">waiting for delay to expire</span>'
@@ -746,6 +1013,8 @@ class TestCase(BasicBase, Base):
     hide_expected = Column(Boolean, default=False, nullable=False,
                            server_default='0')
     name = Column(Unicode, nullable=False)
+    nondeterministic = Column(Boolean, default=False, nullable=False,
+                              server_default='0')
     output_filename = Column(Unicode, nullable=True)
     output_type = Column(Enum('diff', 'image', 'text', name='output_type'),
                          nullable=False, server_default='diff')
@@ -769,6 +1038,7 @@ class TestCase(BasicBase, Base):
     def edit_json(self, jsonify=False):
         data = {'id': self.id, 'name': self.name, 'points': self.points,
                 'source': self.source, 'hide_expected': self.hide_expected,
+                'nondeterministic': self.nondeterministic,
                 'stdin': self.stdin is not None, 'args': self.args,
                 'output_type': self.output_type}
         return json.dumps(data) if jsonify else data
@@ -792,14 +1062,33 @@ class TestCaseResult(Base):
     When the TestCase output_type is not `diff` the diff file is actually
     the raw output file.
 
+    For `diff` test cases `output_matches` records whether the output matched
+    the expected output (it is null for older results, whose diff is null
+    only when it did). When diffs are made lazily a mismatched result stores
+    its raw output file and the diff is made when the result is first viewed.
+
+    The resource usage fields record the user and system CPU time, the wall
+    time (all in seconds) and the peak resident set size (in kilobytes) of
+    the test case's process. They are null for results from older workers.
+
     """
     __tablename__ = 'testcaseresult'
-    diff = relationship(File, backref='test_case_result_for')
+    cpu_sys = Column(Float, nullable=True)
+    cpu_user = Column(Float, nullable=True)
+    diff = relationship(File, primaryjoin='File.id==TestCaseResult.diff_id',
+                        backref='test_case_result_for')
     diff_id = Column(Integer, ForeignKey('file.id'), nullable=True)
+    output = relationship(
+        File, primaryjoin='File.id==TestCaseResult.output_id',
+        backref='test_case_output_for')
+    output_id = Column(Integer, ForeignKey('file.id'), nullable=True)
+    output_matches = Column(Boolean, nullable=True)
     status = Column(Enum('nonexistent_executable', 'output_limit_exceeded',
                          'signal', 'success', 'timed_out',
                          name='status'), nullable=False)
     extra = Column(Integer)
+    max_rss = Column(Integer, nullable=True)
+    wall_time = Column(Float, nullable=True)
     submission_id = Column(Integer, ForeignKey('submission.id'),
                            primary_key=True, nullable=False)
     test_case_id = Column(Integer, ForeignKey('testcase.id'),
@@ -810,7 +1099,36 @@ class TestCaseResult(Base):
         return Session.query(cls).filter_by(
             submission_id=submission_id, test_case_id=test_case_id).first()
 
+    @classmethod
+    def fetch_by_testable(cls, submission_id, testable):
+        """Return a mapping of test case id to result using a single query."""
+        tc_ids = [x.id for x in testable.test_cases]
+        if not tc_ids:
+            return {}
+        return {x.test_case_id: x for x in Session.query(cls).filter(
+            and_(cls.submission_id == submission_id,
+                 cls.test_case_id.in_(tc_ids)))}
+
+    @property
+    def diff_pending(self):
+        """Return whether the output is stored awaiting its diff."""
+        return self.output_matches is False and self.diff is None
+
+    def outputs_match(self):
+        """Return whether or not the output matched the expected output."""
+        if self.output_matches is not None:
+            return self.output_matches
+        return self.diff is None
+
     def update(self, data):
+        """Replace the result with `data` from a new run.
+
+        Resource usage that `data` lacks (e.g., from an older worker) is
+        cleared rather than keeping the figures of the previous run.
+
+        """
+        for attr in ('cpu_sys', 'cpu_user', 'max_rss', 'wall_time'):
+            setattr(self, attr, None)
         for attr, val in data.items():
             setattr(self, attr, val)
         self.created_at = func.now()
@@ -857,6 +1175,38 @@ class Testable(BasicBase, Base):
                                sorted(self.test_cases)]}
         return json.dumps(data) if jsonify else data
 
+    def input_digest(self, submission):
+        """Return a digest of everything that determines this testable's
+        result for `submission`.
+
+        Two (submission, testable) pairs with the same digest are expected to
+        produce the same TestableResult and TestCaseResults. Return None when
+        a test case is marked nondeterministic as its results are not reused.
+
+        """
+        if any(x.nondeterministic for x in self.test_cases):
+            return None
+        submitted = {x.filename: x.file.sha1 for x in submission.files}
+        makefile = self.project.makefile
+        data = {
+            'build_files': sorted((x.filename, x.file.sha1)
+                                  for x in self.build_files),
+            'executable': self.executable,
+            'execution_files': sorted((x.filename, x.file.sha1)
+                                      for x in self.execution_files),
+            'make_target': self.make_target,
+            'makefile': makefile.sha1 if makefile and self.make_target
+            else None,
+            'submitted': sorted((x.filename, x.copy_to_execution,
+                                 submitted.get(x.filename))
+                                for x in self.file_verifiers),
+            'test_cases': sorted(
+                (x.id, x.args, x.expected.sha1 if x.expected else None,
+                 x.output_filename, x.output_type, x.source,
+                 x.stdin.sha1 if x.stdin else None) for x in self.test_cases),
+            'version': RESULT_DIGEST_VERSION}
+        return sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
     def points(self):
         return sum([test_case.points for test_case in self.test_cases])
 
@@ -874,13 +1224,22 @@ class Testable(BasicBase, Base):
             for tcr in (Session.query(TestCaseResult).filter(
                     and_(TestCaseResult.submission == result.submission,
                          TestCaseResult.test_case_id.in_(tc_ids))).all()):
-                if tcr.status == 'success' and tcr.diff is None:
+                if tcr.status == 'success' and tcr.outputs_match():
                     points += tcr.test_case.points
             result.points = points
+        Submission.refresh_project_scores(self.project)
+        GroupScore.refresh_project(self.project)
 
 
 class TestableResult(BasicBase, Base):
+    """Stores the build results of a single testable for a submission.
+
+    `input_digest` is set (see `Testable.input_digest`) only when the result
+    can be reused for another submission with identical inputs.
+
+    """
     __table_args__ = (UniqueConstraint('submission_id', 'testable_id'),)
+    input_digest = Column(String, index=True, nullable=True)
     make_results = Column(UnicodeText, nullable=True)
     points = Column(Integer, nullable=False)
     status = Column(Enum('make_failed', 'nonexistent_executable', 'success',
@@ -890,7 +1249,15 @@ class TestableResult(BasicBase, Base):
     testable_id = Column(Integer, ForeignKey('testable.id'), nullable=False)
 
     @staticmethod
-    def fetch_or_create(make_results, status, **kwargs):
+    def fetch_cached(testable, input_digest, submission):
+        """Return the most recent reusable result for `input_digest`."""
+        return (TestableResult.query_by(testable=testable,
+                                        input_digest=input_digest)
+                .filter(TestableResult.submission_id != submission.id)
+                .order_by(TestableResult.created_at.desc()).first())
+
+    @staticmethod
+    def fetch_or_create(make_results, status, points, **kwargs):
         tr = TestableResult.fetch_by(**kwargs)
         if tr:
             tr.created_at = func.now()
@@ -898,6 +1265,7 @@ class TestableResult(BasicBase, Base):
             tr = TestableResult(**kwargs)
             Session.add(tr)
         tr.make_results = make_results
+        tr.points = points
         tr.status = status
         return tr
 
@@ -1024,6 +1392,8 @@ class User(UserMixin, BasicBase, Base):
         for user in to_assoc.group.users:
             user.files.update(files)
 
+        # Both the submissions and the members of the group may have changed
+        GroupScore.refresh(to_assoc.group)
         return to_assoc.group
 
     def fetch_group_assoc(self, project):
@@ -190,3 +190,128 @@ function showAll( tableID ) {
 function hideAll( tableID ) {
     toggleShowHide( 'h', document.getElementById( tableID ) );
 }
+
+// Client-side rendering of the diffs returned by the submission_item_diff
+// route (see diff_hunks in diff_render.py)
+MAX_SAME_LINES_SHOWN = 5;
+OBSCURED = '&lt;&lt;Expected output obscured by instructor.&gt;&gt;';
+
+function diffText( text ) {
+    if ( text === null ) {
+	return '';
+    }
+    return text.replace( /&/g, '&amp;' ).replace( /</g, '&lt;' )
+	.replace( />/g, '&gt;' ).replace( /\x00\+/g, '<span class="diff_add">' )
+	.replace( /\x00-/g, '<span class="diff_sub">' )
+	.replace( /\x00\^/g, '<span class="diff_chg">' )
+	.replace( /\x01/g, '</span>' );
+}
+
+function diffRow( fromLine, fromText, toLine, toText, differs ) {
+    var fromClass = differs ? 'diff_text diff_text_sub' : 'diff_text';
+    var toClass = differs ? 'diff_text diff_text_add' : 'diff_text';
+    return '<tr><td class="diff_header">' + ( fromLine || '' ) + '</td>' +
+	'<td class="' + fromClass + '">' + fromText + '</td>' +
+	'<td class="diff_header">' + ( toLine || '' ) + '</td>' +
+	'<td class="' + toClass + '">' + toText + '</td></tr>';
+}
+
+function renderDiff( data ) {
+    var obscured = OBSCURED;
+    // Return the expected text to show, which is obscured once when hidden
+    var expected = function( text ) {
+	if ( !data.hide_expected ) {
+	    return diffText( text );
+	}
+	var retval = obscured;
+	obscured = '';
+	return retval;
+    };
+    var html = '<table class="diff diff_client" cellspacing="0" ' +
+	'cellpadding="0"><thead><tr>' +
+	'<th colspan="2" class="diff_header">Correct Output</th>' +
+	'<th colspan="2" class="diff_header">Your Output</th>' +
+	'</tr></thead><tbody>';
+    if ( data.hunks.length === 0 ) {
+	html += diffRow( '', '&nbsp;Empty File&nbsp;', '',
+			 '&nbsp;Empty File&nbsp;', false );
+    }
+    for (var hunkID = 0; hunkID < data.hunks.length; hunkID++) {
+	var hunk = data.hunks[ hunkID ];
+	if ( hunk[ 0 ] === 1 ) {
+	    for (var rowID = 0; rowID < hunk[ 1 ].length; rowID++) {
+		var row = hunk[ 1 ][ rowID ];
+		html += diffRow( row[ 0 ], expected( row[ 1 ] ), row[ 2 ],
+				 diffText( row[ 3 ] ), true );
+	    }
+	    continue;
+	}
+	var lines = hunk[ 3 ];
+	var collapse = lines.length > MAX_SAME_LINES_SHOWN;
+	for (var lineID = 0; lineID < lines.length; lineID++) {
+	    if ( collapse && lineID === 2 ) {
+		html += '</tbody><tbody style="display:none">';
+	    }
+	    html += diffRow( hunk[ 1 ] + lineID, expected( lines[ lineID ] ),
+			     hunk[ 2 ] + lineID, diffText( lines[ lineID ] ),
+			     false );
+	    if ( collapse && lineID === lines.length - 3 ) {
+		html += '</tbody><tbody><tr><td colspan="4" ' +
+		    'class="diff_next"><a href="javascript:void(0)" ' +
+		    'onclick="toggleSame( this );">&lt;&lt;' +
+		    ( lines.length - 4 ) + ' same lines&gt;&gt;</a>' +
+		    '</td></tr></tbody><tbody>';
+	    }
+	}
+    }
+    if ( data.truncated ) {
+	var truncated = '&lt;&lt;Remaining diff not shown&gt;&gt;';
+	html += diffRow( '...', truncated, '...', truncated, false );
+    }
+    return html + '</tbody></table>';
+}
+
+// shows or hides the same lines preceding the link's row
+function toggleSame( a ) {
+    $( a ).closest( 'tbody' ).prev().toggle();
+}
+
+// loads the placeholder's diff the first time it is opened
+function toggleDiff( placeholder ) {
+    var link = $( placeholder ).children( 'a' );
+    var table = $( placeholder ).children( 'table, .diff_error' );
+    if ( table.length ) {
+	table.toggle();
+	link.text( table.is( ':visible' ) ? 'Hide diff' : 'Show diff' );
+	return;
+    }
+    if ( $( placeholder ).data( 'loading' ) ) {
+	return;
+    }
+    $( placeholder ).data( 'loading', true );
+    link.text( 'Loading diff...' );
+    $.getJSON( $( placeholder ).data( 'url' ) ).done( function( data ) {
+	$( placeholder ).append( renderDiff( data ) );
+	link.text( 'Hide diff' );
+    } ).fail( function() {
+	$( placeholder ).append(
+	    '<div class="diff_error">The diff could not be loaded.</div>' );
+	link.text( 'Hide diff' );
+    } ).always( function() {
+	$( placeholder ).data( 'loading', false );
+    } );
+}
+
+// opens the diff of the test case linked to from the summary
+function openLinkedDiff() {
+    var id = decodeURIComponent( window.location.hash.substr( 1 ) );
+    var target = id ? document.getElementById( id ) : null;
+    if ( target === null ) {
+	return;
+    }
+    $( target ).children( '.diff_placeholder' ).each( function() {
+	if ( !$( this ).children( 'table:visible' ).length ) {
+	    toggleDiff( this );
+	}
+    } );
+}
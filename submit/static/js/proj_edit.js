@@ -145,6 +145,8 @@ table-hover">');
                 data['output_type']);
         else if (data['hide_expected'])
             other += '<span class="label label-important">Hide Expected</span>'
+        if (data['nondeterministic'])
+            other += '<span class="label label-warning">Nondeterministic</span>'
         $('<tr><td><span class="btn btn-warning btn-mini" onclick="$(\'#update\
 _tc_{0}\').dialog(\'open\');"><i class="icon-white icon-pencil"></i> Edit\
 </span> {1}</td><td>{2}</td></tr>'
@@ -0,0 +1,214 @@
+import json
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+from datetime import datetime
+from hashlib import sha1
+from pyramid import testing
+from sqlalchemy import create_engine, event
+from .diff_render import FragmentCache
+from .diff_unit import Diff
+from .models import (Base, Class, File, FileVerifier, Group, Project, Session,
+                     Submission, SubmissionToFile, TestCase, TestCaseResult,
+                     Testable, TestableResult, User, UserToGroup,
+                     VerificationResults)
+from .views import submission_view
+from .workers.proxy import ArchiveResults, BuildCache
+from .workers.worker import RESULTS_ARCHIVE, CorruptFile, Worker
+
+
+class BuildCacheTest(unittest.TestCase):
+
+    """Run jobs through the worker and the proxy's build cache."""
+
+    FILES = {'Makefile': 'hello: hello.sh\n\tcp hello.sh hello\n',
+             'src/hello.sh': '#!/bin/sh\necho hello\n'}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        self.cache = BuildCache(os.path.join(self.path, 'cache'), 1048576)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def run_job(self, name, tamper=False):
+        """Run a job of a single testable and return its results.
+
+        With `tamper` the build sent from the cache is modified before the
+        worker runs.
+
+        """
+        working_path = os.path.join(self.path, name, 'working')
+        testable_path = os.path.join(working_path, 't_1')
+        os.makedirs(os.path.join(testable_path, 'src'))
+        manifest = {}
+        for filename, data in self.FILES.items():
+            with open(os.path.join(testable_path, filename), 'w') as fp:
+                fp.write(data)
+            os.chmod(os.path.join(testable_path, filename), 0o755)
+            manifest[filename] = sha1(data).hexdigest()
+        key = BuildCache.key(manifest, 'hello')
+        build = self.cache.fetch(key, os.path.join(testable_path, 'build'))
+        if tamper:
+            with open(os.path.join(testable_path, 'build', 'hello'),
+                      'a') as fp:
+                fp.write('echo tampered\n')
+        data = {'build_cache': build, 'build_key': key,
+                'executable': 'hello', 'key': '1.1', 'make_target': 'hello',
+                'return_build': not build,
+                'test_cases': [{'args': 'hello', 'id': 1,
+                                'output_filename': None, 'source': 'stdout',
+                                'stdin': None}]}
+        for filename, value in (('data.json', data),
+                                ('manifest.json', manifest)):
+            with open(os.path.join(testable_path, filename), 'w') as fp:
+                json.dump(value, fp)
+        with open(os.path.join(working_path, 'data.json'), 'w') as fp:
+            json.dump({'key': '1.1', 'pack_results': True,
+                       'testables': [1]}, fp)
+        Worker(working_path, os.path.join(self.path, name)).run()
+        with open(os.path.join(working_path, RESULTS_ARCHIVE), 'rb') as fp:
+            results = ArchiveResults(fp.read())
+
+        def read(filename):
+            return results.read('t_1/results/' + filename)
+        self.cache.store(key, read)
+        return read
+
+    def test_second_job_reuses_build(self):
+        read = self.run_job('first')
+        self.assertFalse(json.loads(read('timings'))['build_cache']['hit'])
+        read = self.run_job('second')
+        self.assertTrue(json.loads(read('timings'))['build_cache']['hit'])
+        self.assertEqual('success', json.loads(read('testable'))['status'])
+        self.assertEqual('hello\n', read('tc_1'))
+        self.assertEqual(None, read('build.json'))
+
+    def test_modified_build_is_rejected(self):
+        self.run_job('first')
+        self.assertRaises(CorruptFile, self.run_job, 'second', tamper=True)
+
+
+class SubmissionViewQueryTest(unittest.TestCase):
+
+    """Pin the number of queries `submission_view` makes.
+
+    The view is called as an admin, thus the links to the adjacent
+    submissions and groups are included. The number of queries must not
+    depend on the number of testables, test cases, groups or submissions.
+
+    """
+
+    MAX_QUERIES = 23
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.config = testing.setUp(settings={'file_directory':
+                                              self.base_path})
+        self.config.registry.rendered_diff_cache = FragmentCache(64)
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        Session.configure(bind=self.engine)
+        self.projects = 0
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+        shutil.rmtree(self.base_path)
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def make_submission(self, num_testables, num_test_cases, num_groups=1):
+        """Return the id of a submission with results for every test case.
+
+        Each of the `num_groups` groups has made two submissions and the
+        second submission of the first group is returned.
+
+        """
+        self.projects += 1
+        name = 'p{0}'.format(self.projects)
+        project = Project(class_=Class(name=name), name=name)
+        expected = File.fetch_or_create('output\n', self.base_path)
+        actual = File.fetch_or_create('other\n', self.base_path)
+        diff = File.fetch_or_create(
+            Diff('output\n', 'other\n').serialize(expected.sha1, actual.sha1),
+            self.base_path)
+        submitted = File.fetch_or_create('submitted\n', self.base_path)
+        file_verifier = FileVerifier(filename='a.c', min_lines=0, min_size=0,
+                                     optional=False, project=project)
+        test_cases = []
+        for i in range(num_testables):
+            testable = Testable(executable='a', is_hidden=i % 2 == 1,
+                                name='t{0}'.format(i), project=project)
+            testable.file_verifiers.append(file_verifier)
+            for j in range(num_test_cases):
+                test_cases.append(TestCase(
+                    args='a', expected=expected, name='tc{0}'.format(j),
+                    output_type='diff', points=1, source='stdout',
+                    testable=testable))
+        submissions = []
+        for i in range(num_groups):
+            username = '{0}_{1}'.format(name, i)
+            user = User(is_admin=False, name=username, username=username)
+            group = Group(project=project)
+            Session.add(UserToGroup(group=group, project=project, user=user))
+            for _ in range(2):
+                submission = Submission(
+                    created_at=datetime.now(), created_by=user, group=group,
+                    project=project,
+                    verification_results=VerificationResults(),
+                    verified_at=datetime.now())
+                submission.files.append(SubmissionToFile(filename='a.c',
+                                                         file=submitted))
+                for testable in project.testables:
+                    submission.testable_results.append(TestableResult(
+                        points=num_test_cases, status='success',
+                        testable=testable))
+                for j, test_case in enumerate(test_cases):
+                    submission.test_case_results.append(TestCaseResult(
+                        diff=diff if j % 2 else None, extra=0,
+                        output=actual if j % 2 else expected,
+                        output_matches=not j % 2, status='success',
+                        test_case=test_case, wall_time=0.1))
+                Session.add(submission)
+                Session.flush()
+                submissions.append(submission)
+        submission_id = submissions[1].id
+        Session.expunge_all()
+        return submission_id
+
+    def count_queries(self, submission_id):
+        request = testing.DummyRequest(
+            matchdict={'submission_id': str(submission_id)})
+        request.user = User(is_admin=True, name='admin', username='admin')
+        del self.statements[:]
+        info = submission_view(request)
+        count = len(self.statements)
+        self.assertEqual(submission_id, info['submission'].id)
+        self.assertTrue(info['submission_admin'])
+        self.assertTrue(info['diff_table'])
+        self.assertEqual(None, info['next_sub_id'])
+        self.assertNotEqual(None, info['prev_sub_id'])
+        self.assertEqual(None, info['prev_group_sub'])
+        Session.expunge_all()
+        return count
+
+    def test_queries_do_not_grow_with_testables_or_test_cases(self):
+        small = self.count_queries(self.make_submission(1, 1))
+        self.assertLessEqual(small, self.MAX_QUERIES)
+        self.assertEqual(small, self.count_queries(self.make_submission(4, 1)))
+        self.assertEqual(small, self.count_queries(self.make_submission(1, 6)))
+        self.assertEqual(small, self.count_queries(self.make_submission(4, 6)))
+
+    def test_queries_do_not_grow_with_groups(self):
+        for num_groups in (2, 6):
+            self.assertEqual(self.MAX_QUERIES, self.count_queries(
+                self.make_submission(2, 2, num_groups=num_groups)))
@@ -12,38 +12,34 @@ from pyramid_addons.validation import (EmailAddress, Enum, List, Or, String,
                                        WhiteSpaceString, validate, SOURCE_GET,
                                        SOURCE_MATCHDICT as MATCHDICT)
 from pyramid.httpexceptions import (HTTPBadRequest, HTTPConflict, HTTPError,
-                                    HTTPFound, HTTPNotFound, HTTPOk,
-                                    HTTPRedirection, HTTPSeeOther)
+                                    HTTPForbidden, HTTPFound, HTTPNotFound,
+                                    HTTPOk, HTTPRedirection, HTTPSeeOther)
 from pyramid.response import FileResponse, Response
 from pyramid.security import forget, remember
 from pyramid.settings import asbool
 from pyramid.view import (forbidden_view_config, notfound_view_config,
                           view_config)
 import re 
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload_all
 import yaml
 from zipfile import ZipFile
-from .diff_render import HTMLDiff
+from .diff_render import MAX_NUM_REVEALS, HTMLDiff, diff_hunks
+from .diff_unit import DiffWithMetadata
 from .exceptions import GroupWithException, InvalidId, SubmitException
 from .helpers import (
     AccessibleDBThing, DBThing as AnyDBThing, DummyTemplateAttr,
     EditableDBThing, TestableStatus, TextDate, ViewableDBThing, UmailAddress,
-    add_user, clone, fetch_request_ids, file_verifier_verification,
+    add_user, alphanum_key, clone, fetch_request_ids,
+    file_verifier_verification,
     prepare_renderable, prev_next_submission, prev_next_group,
     project_file_create, project_file_delete, send_email,
     test_case_verification, zip_response,zip_response_adv)
 from .models import (BuildFile, Class, ExecutionFile, File, FileVerifier,
-                     Group, GroupRequest, PasswordReset, Project, Session,
-                     Submission, SubmissionToFile, TestCase, Testable, User,
-                     UserToGroup)
-
-# Hack for old pickle files
-# TODO: Migrate this data to not use pickle
-import sys
-import submit
-sys.modules['nudibranch'] = submit
-sys.modules['nudibranch.diff_unit'] = submit.diff_unit
-sys.modules['nudibranch.models'] = submit.models
+                     Group, GroupRequest, GroupScore, PasswordReset, Project,
+                     Session, Submission, SubmissionToFile, TestCase,
+                     TestCaseResult, Testable, User, UserToGroup)
 
 # A few reoccuring validators
 OUTPUT_SOURCE = Enum('output_source', 'stdout', 'stderr', 'file')
@@ -127,6 +123,8 @@ def class_admins_add(request, class_, user):
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('The user could not be added.')
+    for project in class_.projects:  # The user's groups are no longer scored
+        GroupScore.refresh_project(project)
     request.session.flash('Added {} as an admin to the class.'.format(user),
                           'successes')
     return http_ok(request, redir_location=request.url)
@@ -183,7 +181,7 @@ def class_view(request, class_):
     if class_admin:
         project_ids = [x.id for x in class_.projects]
         if project_ids:
-            recent_subs = (Submission.query_by()
+            recent_subs = (Submission.query_with_scores()
                            .filter(Submission.project_id.in_(project_ids))
                            .order_by(Submission.created_at.desc()).limit(16)
                            .all())
@@ -578,6 +576,7 @@ It may be imported again using the import feature""" % project.name))
             # create a dict to hold the information for the test case!
             tc_dict = {}
             tc_dict["HideExpected"] = test_case.hide_expected
+            tc_dict["Nondeterministic"] = test_case.nondeterministic
             tc_dict["Points"] = test_case.points
             tc_dict["Command"] = test_case.args
             if test_case.stdin != None:
@@ -796,6 +795,7 @@ def project_import(request, project):
                                     args = testable_yml["TestCases"][test_case_name]["Args"],
                                     expected =  get_or_create_file(testable_yml["TestCases"][test_case_name]["STDOUT"], rootdir=testable_folder),
                                     hide_expected = testable_yml["TestCases"][test_case_name]["HideExpected"],
+                                    nondeterministic = testable_yml["TestCases"][test_case_name].get("Nondeterministic", False),
                                     name = test_case_name,
                                     points = testable_yml["TestCases"][test_case_name]["Points"],
                                     stdin = get_or_create_file(testable_yml["TestCases"][test_case_name]["STDIN"], rootdir=testable_folder)
@@ -1079,11 +1079,13 @@ def project_new(request, class_):
 
 @view_config(route_name='project_edit', renderer='json',
              request_method='PUT', permission='authenticated')
-@validate(project=EditableDBThing('project_id', Project, source=MATCHDICT))
-def project_requeue(request, project):
+@validate(project=EditableDBThing('project_id', Project, source=MATCHDICT),
+          force=TextNumber('force', min_value=0, max_value=1, optional=True))
+def project_requeue(request, project, force):
     count = 0
     for count, submission in enumerate(project.recent_submissions(), start=1):
-        request.queue(submission_id=submission.id, _priority=2)
+        request.queue(submission_id=submission.id, force=bool(force),
+                      _priority=2)
     if count == 0:
         return http_ok(request, message='There are no submissions to requeue.')
     request.session.flash('Requeued the most recent submissions ({0} items).'
@@ -1096,13 +1098,12 @@ def project_requeue(request, project):
 @validate(project=EditableDBThing('project_id', Project, source=MATCHDICT))
 def project_scores(request, project):
     rows = ['Name, Email, Group ID, Score (On Time), Score']
-    _, best_ontime, best = project.process_submissions()
-    for group, (sub, points) in best.items():
-        on_time = best_ontime[group][1] if group in best_ontime else ''
-        for user in group.users:
+    for score in GroupScore.fetch_for_project(project):
+        on_time = score.best_ontime_points if score.best_ontime_id else ''
+        for user in score.group.users:
             rows.append('{}, {}, {}, {}, {}'
-                        .format(user.name, user.username, group.id,
-                                points, on_time))
+                        .format(user.name, user.username, score.group_id,
+                                score.best_points, on_time))
     disposition = 'attachment; filename="{0}.csv"'.format(project.name)
     return Response(body='\n'.join(rows), content_type=str('text/csv'),
                     content_disposition=disposition)
@@ -1166,6 +1167,7 @@ def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
     # Fix timezone if it doesn't exist
     if project.deadline and deadline and not deadline.tzinfo:
         deadline = deadline.replace(tzinfo=project.deadline.tzinfo)
+    deadline_changed = deadline != project.deadline
     if not project.update(name=name, makefile=makefile, deadline=deadline,
                           delay_minutes=delay_minutes,
                           group_max=group_max,
@@ -1175,6 +1177,8 @@ def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That project name already exists for the class')
+    if deadline_changed:  # Which submissions are on time may have changed
+        GroupScore.refresh_project(project)
     request.session.flash('Project updated', 'successes')
     redir_location = request.route_path('project_edit', project_id=project.id)
     return http_ok(request, redir_location=redir_location)
@@ -1187,7 +1191,7 @@ def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
 @validate(project=AccessibleDBThing('project_id', Project, source=MATCHDICT),
           group=ViewableDBThing('group_id', Group, source=MATCHDICT))
 def project_view_detailed(request, project, group):
-    submissions = Submission.query_by(project=project, group=group)
+    submissions = Submission.query_with_scores(project=project, group=group)
     if not submissions:
         raise HTTPNotFound()
 
@@ -1239,11 +1243,11 @@ def project_view_detailed_user(request, project, user):
 @validate(project=ViewableDBThing('project_id', Project, source=MATCHDICT))
 def project_view_summary(request, project):
     # Compute student stats
-    by_group, best_ontime, best = project.process_submissions()
+    scores = GroupScore.fetch_for_project(project)
     possible = project.points_possible(include_hidden=True)
-    if best:
-        best_scores = numpy.array([x[1] for x in best.values()])
-        normed = [min(x[1], possible) for x in best.values()]
+    if scores:
+        best_scores = numpy.array([x.best_points for x in scores])
+        normed = [min(x.best_points, possible) for x in scores]
         max_score = max(best_scores)
         mean = numpy.mean(best_scores)
         median = numpy.median(best_scores)
@@ -1253,28 +1257,33 @@ def project_view_summary(request, project):
     else:
         hist = max_score = mean = median = None
 
-    # Find most recent for each group
+    # Find the most recent and the best submissions for each group
+    best_ids = set()
+    for score in scores:
+        best_ids.add(score.best_id)
+        if score.best_ontime_id:
+            best_ids.add(score.best_ontime_id)
+    by_group = {}
+    for submission in Submission.most_recent_by_group(project, 3, best_ids):
+        if submission.id in best_ids:
+            submission._is_best = True
+        by_group.setdefault(submission.group_id, []).append(submission)
+    counts = dict(Session.query(Submission.group_id, func.count(Submission.id))
+                  .filter(Submission.project_id == project.id)
+                  .group_by(Submission.group_id))
     submissions = {}
     group_truncated = set()
-    for group in project.groups:
-        if group in by_group:
-            newest = by_group[group][:-4:-1]
-            if group in best:
-                best[group][0]._is_best = True
-                if best[group][0] not in newest:
-                    newest.append(best[group][0])
-            if group in best_ontime:
-                best_ontime[group][0]._is_best = True
-                if best_ontime[group][0] not in newest:
-                    newest.append(best_ontime[group][0])
-            if len(newest) < len(by_group[group]):
-                group_truncated.add(group)
-            submissions[group] = newest
-
-        else:
-            submissions[group] = []
+    for group in (Group.query_by(project=project)
+                  .options(subqueryload_all(Group.group_assocs,
+                                            UserToGroup.user))):
+        group_submissions = sorted(by_group.get(group.id, []), reverse=True)
+        newest = group_submissions[:3]
+        newest.extend(x for x in group_submissions[3:] if x.id in best_ids)
+        if len(newest) < counts.get(group.id, 0):
+            group_truncated.add(group)
+        submissions[group] = newest
     # The 16 most recent submissions
-    recent_submissions = (Submission.query_by(project=project)
+    recent_submissions = (Submission.query_with_scores(project=project)
                           .order_by(Submission.created_at.desc())
                           .limit(16).all())
     return {'group_truncated': group_truncated,
@@ -1282,7 +1291,8 @@ def project_view_summary(request, project):
             'max': max_score,
             'mean': mean,
             'median': median,
-            'num_groups': len(best),
+            'num_groups': len(scores),
+            'num_submissions': sum(x.submissions for x in scores),
             'project': project,
             'recent_submissions': recent_submissions,
             'submissions': sorted(submissions.items())}
@@ -1391,9 +1401,11 @@ def submission_new(request, project):
 @view_config(route_name='submission_item', renderer='json',
              request_method='PUT', permission='authenticated')
 @validate(submission=EditableDBThing('submission_id', Submission,
-                                     source=MATCHDICT))
-def submission_requeue(request, submission):
-    request.queue(submission_id=submission.id, _priority=0)
+                                     source=MATCHDICT),
+          force=TextNumber('force', min_value=0, max_value=1, optional=True))
+def submission_requeue(request, submission, force):
+    request.queue(submission_id=submission.id, force=bool(force),
+                  _priority=0)
     request.session.flash('Requeued the submission', 'successes')
     return http_ok(request, redir_location=request.url)
 
@@ -1406,6 +1418,7 @@ def submission_requeue(request, submission):
           as_user=TextNumber('as_user', min_value=0, max_value=1,
                              optional=True, source=SOURCE_GET))
 def submission_view(request, submission, as_user):
+    submission.load_results()
     actual_admin = submission.project.can_edit(request.user)
     submission_admin = not bool(as_user) and actual_admin
     if not submission_admin:  # Only check delay for user view
@@ -1414,21 +1427,31 @@ def submission_view(request, submission, as_user):
         if delay:
             request.override_renderer = 'templates/submission_delay.pt'
             files = {x.filename: x.file for x in submission.files}
-            prev_sub, next_sub = prev_next_submission(submission)
+            prev_sub_id, next_sub_id = prev_next_submission(submission)
             return {'delay': '{0:.1f} minutes'.format(delay),
                     'files': files,
-                    'next_sub': next_sub,
-                    'prev_sub': prev_sub,
+                    'next_sub_id': next_sub_id,
+                    'prev_sub_id': prev_sub_id,
                     'submission': submission,
                     'submission_admin': actual_admin}
 
     points_possible = submission.project.points_possible(
         include_hidden=submission_admin)
+    cache = request.registry.rendered_diff_cache
+    diff_url = None
+    if asbool(request.registry.settings.get('client_side_diffs', False)):
+        def diff_url(renderable):
+            return request.route_path(
+                'submission_item_diff', submission_id=submission.id,
+                test_case_id=renderable.number,
+                _query={'as_user': 1} if as_user else {})
     if submission_admin:
-        diff_renderer = HTMLDiff(num_reveal_limit=None,
+        diff_renderer = HTMLDiff(cache=cache, diff_url=diff_url,
+                                 num_reveal_limit=None,
                                  points_possible=points_possible)
     else:
-        diff_renderer = HTMLDiff(points_possible=points_possible)
+        diff_renderer = HTMLDiff(cache=cache, diff_url=diff_url,
+                                 points_possible=points_possible)
 
     for tcr in submission.test_case_results:
         if submission_admin or not tcr.test_case.testable.is_hidden:
@@ -1464,28 +1487,73 @@ def submission_view(request, submission, as_user):
     else:
         diff_table = None
 
+    if submission_admin:  # Resource usage of each test case
+        resource_usage = sorted(
+            (x for x in submission.test_case_results
+             if x.wall_time is not None),
+            key=lambda x: (alphanum_key(x.test_case.testable.name),
+                           alphanum_key(x.test_case.name)))
+    else:
+        resource_usage = None
+
     # Do this after we've potentially updated the session
-    prev_sub, next_sub = prev_next_submission(submission)
-    if submission_admin:
-        prev_group, next_group = prev_next_group(submission.project,
-                                                 submission.group)
+    prev_sub_id, next_sub_id = prev_next_submission(submission)
+    if submission_admin:  # Link to the most recent submission of each group
+        prev_group_sub, next_group_sub = [
+            Submission.most_recent_submission(submission.project, x)
+            if x else None
+            for x in prev_next_group(submission.project, submission.group)]
     else:
-        prev_group = next_group = None
+        prev_group_sub = next_group_sub = None
 
     return {'diff_table': diff_table,
             'extra_files': extra_files,
             'files': files,
-            'next_sub': next_sub,
-            'next_group': next_group,
+            'next_group_sub': next_group_sub,
+            'next_sub_id': next_sub_id,
             'pending': pending,
-            'prev_sub': prev_sub,
-            'prev_group': prev_group,
+            'prev_group_sub': prev_group_sub,
+            'prev_sub_id': prev_sub_id,
+            'resource_usage': resource_usage,
             'submission': submission,
             'submission_admin': submission_admin,
             'testable_issues': testable_issues,
             'warnings': warnings}
 
 
+@view_config(route_name='submission_item_diff', request_method='GET',
+             permission='authenticated', renderer='json')
+@validate(submission=ViewableDBThing('submission_id', Submission,
+                                     source=MATCHDICT),
+          test_case=AnyDBThing('test_case_id', TestCase, source=MATCHDICT),
+          as_user=TextNumber('as_user', min_value=0, max_value=1,
+                             optional=True, source=SOURCE_GET))
+def submission_diff(request, submission, test_case, as_user):
+    """Return the diff of a test case's output for rendering by the browser.
+
+    What is revealed is limited exactly as in `submission_view`.
+
+    """
+    submission_admin = not bool(as_user) and \
+        submission.project.can_edit(request.user)
+    if not submission_admin:
+        if submission.get_delay(update=False):
+            raise HTTPForbidden('The results are not yet available')
+        if test_case.testable.is_hidden:
+            raise HTTPNotFound()
+    test_case_result = TestCaseResult.fetch_by_ids(submission.id,
+                                                   test_case.id)
+    if not test_case_result or test_case.output_type != 'diff':
+        raise HTTPNotFound()
+    renderable = prepare_renderable(request, test_case_result,
+                                    submission_admin)
+    if not isinstance(renderable, DiffWithMetadata) or \
+            not renderable.show_diff_table():
+        raise HTTPNotFound()
+    return diff_hunks(renderable.diff,
+                      None if submission_admin else MAX_NUM_REVEALS)
+
+
 @view_config(route_name='test_case', request_method='PUT',
              permission='authenticated', renderer='json')
 @validate(name=String('name', min_length=1),
@@ -1493,6 +1561,8 @@ def submission_view(request, submission, as_user):
           expected=ViewableDBThing('expected_id', File, optional=True),
           hide_expected=TextNumber('hide_expected', min_value=0, max_value=1,
                                    optional=True),
+          nondeterministic=TextNumber('nondeterministic', min_value=0,
+                                      max_value=1, optional=True),
           output_filename=String('output_filename', min_length=1,
                                  optional=True),
           output_source=OUTPUT_SOURCE, output_type=OUTPUT_TYPE,
@@ -1501,10 +1571,11 @@ def submission_view(request, submission, as_user):
           testable=EditableDBThing('testable_id', Testable))
 @test_case_verification
 def test_case_create(request, name, args, expected, hide_expected,
-                     output_filename, output_source, output_type, points,
-                     stdin, testable):
+                     nondeterministic, output_filename, output_source,
+                     output_type, points, stdin, testable):
     test_case = TestCase(name=name, args=args, expected=expected,
                          hide_expected=bool(hide_expected),
+                         nondeterministic=bool(nondeterministic),
                          output_filename=output_filename,
                          output_type=output_type, points=points,
                          source=output_source, stdin=stdin, testable=testable)
@@ -1541,6 +1612,8 @@ def test_case_delete(request, test_case):
           expected=ViewableDBThing('expected_id', File, optional=True),
           hide_expected=TextNumber('hide_expected', min_value=0, max_value=1,
                                    optional=True),
+          nondeterministic=TextNumber('nondeterministic', min_value=0,
+                                      max_value=1, optional=True),
           output_filename=String('output_filename', min_length=1,
                                  optional=True),
           output_source=OUTPUT_SOURCE, output_type=OUTPUT_TYPE,
@@ -1550,10 +1623,11 @@ def test_case_delete(request, test_case):
                                     source=MATCHDICT))
 @test_case_verification
 def test_case_update(request, name, args, expected, hide_expected,
-                     output_filename, output_source, output_type, points,
-                     stdin, test_case):
+                     nondeterministic, output_filename, output_source,
+                     output_type, points, stdin, test_case):
     if not test_case.update(name=name, args=args, expected=expected,
                             hide_expected=bool(hide_expected),
+                            nondeterministic=bool(nondeterministic),
                             output_filename=output_filename,
                             output_type=output_type, points=points,
                             source=output_source, stdin=stdin):
@@ -1618,6 +1692,8 @@ def testable_create(request, name, is_hidden, make_target, executable,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That name already exists for the project')
+    # Existing submissions have yet to be run against the testable
+    Submission.refresh_project_scores(project)
     return http_created(request, redir_location=redir_location,
                         testable_id=testable.id)
 
@@ -1668,6 +1744,8 @@ def testable_edit(request, name, is_hidden, make_target, executable,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That name already exists for the project')
+    # Points move between visible and hidden when is_hidden changes
+    Submission.refresh_project_scores(testable.project)
     request.session.flash('Updated Testable {0}.'.format(testable.name),
                           'successes')
     redir_location = request.route_path('project_edit',
@@ -1683,7 +1761,11 @@ def testable_delete(request, testable):
                                         project_id=testable.project.id)
     request.session.flash('Deleted Testable {0}.'.format(testable.name),
                           'successes')
+    project = testable.project
     Session.delete(testable)
+    # Update the scores without the testable's results
+    Submission.refresh_project_scores(project)
+    GroupScore.refresh_project(project)
     return http_ok(request, redir_location=redir_location)
 
 
@@ -1738,7 +1820,7 @@ def user_view(request, user):
                    .filter(UserToGroup.user == user).all()]
     admin_subs = user_subs = None
     if user_groups:
-        user_subs = (Submission.query_by()
+        user_subs = (Submission.query_with_scores()
                      .filter(Submission.group_id.in_(user_groups))
                      .order_by(Submission.created_at.desc()).limit(10).all())
     admin_classes = user.classes_can_admin()
@@ -1748,7 +1830,7 @@ def user_view(request, user):
                        .filter(Project.class_id.in_(class_ids))
                        .all()]
         if class_projs:
-            admin_subs = (Submission.query_by()
+            admin_subs = (Submission.query_with_scores()
                           .filter(Submission.project_id.in_(class_projs))
                           .order_by(Submission.created_at.desc()).limit(10)
                           .all())
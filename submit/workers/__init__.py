@@ -1,8 +1,10 @@
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 import os
 import shutil
 import tempfile
+import time
 import transaction
 
 BASE_FILE_PATH = None
@@ -12,22 +14,76 @@ def log_msg(msg):
     print('{} {}'.format(datetime.now(), msg))
 
 
+class StageTimer(object):
+
+    """Accumulate the wall time spent in each named stage of a job.
+
+    Use an instance as a context manager factory: `with timer('push'): ...`.
+    Stages that are entered more than once, e.g., on retries, accumulate.
+
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def __str__(self):
+        return ' '.join('{}={:.3f}'.format(stage, seconds) for stage, seconds
+                        in sorted(self.stages.items()))
+
+
 def wrapper(func):
+    func = transactional(func)
+
     @wraps(func)
     def wrapped(*args, **kwargs):
         # Create temporary directory
         prev_cwd = os.getcwd()
         new_cwd = tempfile.mkdtemp()
         os.chdir(new_cwd)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Remove temporary directory
+            shutil.rmtree(new_cwd)
+            os.chdir(prev_cwd)
+    return wrapped
+
+
+def transactional(func):
+    """Commit the transaction when `func` succeeds and abort it otherwise.
+
+    Unlike `wrapper` the working directory is left alone so the decorated
+    function can run in several threads at once.
+
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
         try:
             retval = func(*args, **kwargs)
             transaction.commit()
         except:
             transaction.abort()
             raise
-        finally:
-            # Remove temporary directory
-            shutil.rmtree(new_cwd)
-            os.chdir(prev_cwd)
         return retval
     return wrapped
+
+
+@contextmanager
+def job_directory():
+    """Yield the path to a temporary directory that is removed afterwards."""
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
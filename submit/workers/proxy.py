@@ -1,194 +1,1045 @@
 import amqp_worker
+import functools
 import json
+import multiprocessing
 import os
-import pickle
+import pika
 import random
+import re
+import select
+import signal
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
-from heapq import heappop, heappush
+import traceback
+import transaction
+from contextlib import closing
+from hashlib import sha1 as sha1_hash
+from io import BytesIO
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
 from .exceptions import HandledError, SSHConnectTimeout
 from .. import workers
+from ..diff_render import prune_files
 from ..diff_unit import Diff
-from ..models import (File, Session, Submission, TestCaseResult, Testable,
-                      TestableResult, configure_sql)
+from ..models import (DiffCache, File, GroupScore, Session, Submission,
+                      TestCaseResult, Testable, TestableResult, configure_sql)
 
 
-def set_expected_files(testable, results, base_file_path):
+def set_expected_files(testable, results, base_file_path, read):
     # Update the expected output of each test case
     for test_case in testable.test_cases:
         if test_case.id not in results:
             raise Exception('Missing test case result in project update: {0}'
                             .format(test_case.id))
         if test_case.output_type == 'diff':
-            output_file = 'tc_{0}'.format(test_case.id)
-            test_case.expected = File.fetch_or_create(
-                open(output_file).read(), base_file_path)
+            output = read('tc_{0}'.format(test_case.id))
+            if output is None:
+                raise Exception('Missing output in project update: {0}'
+                                .format(test_case.id))
+            test_case.expected = File.fetch_or_create(output, base_file_path)
     testable.is_locked = False
     if not any(x.is_locked for x in testable.project.testables):
         testable.project.status = u'notready'
 
 
-def compute_diff(test_case, test_case_result, output_file, base_file_path):
-    """Associate the diff (if exists) with the TestCaseResult.
+class DiffTimeout(Exception):
+    """Indicate a diff exceeded its CPU time budget."""
 
-    Return whether or not the outputs match.
+
+def raise_diff_timeout(signum, frame):
+    raise DiffTimeout()
+
+
+def init_diff_process():
+    signal.signal(signal.SIGPROF, raise_diff_timeout)
+
+
+def make_diff(pair, expected_file, actual_output, cpu_limit=None,
+              coarse=False):
+    """Diff the actual output against the expected output file.
+
+    `pair` holds the sha1sums of the expected and actual outputs which the
+    compact diff references. `actual_output` is None when the test case
+    produced no output file. When the diff takes more than `cpu_limit` seconds
+    of CPU time a coarse diff is made instead (the limit is only applied
+    within the diff pool).
+
+    Return a tuple of the serialized Diff (None when the outputs match) and
+    whether or not the diff is coarse.
 
     """
-    with open(File.file_path(base_file_path, test_case.expected.sha1)) as fp:
+    with open(expected_file) as fp:
         expected_output = fp.read()
-    actual_output = ''
-    if os.path.isfile(output_file):
-        with open('tc_{0}'.format(test_case.id)) as fp:
-            actual_output = fp.read()
-    unit = Diff(expected_output, actual_output)
-    if not unit.outputs_match():
-        test_case_result.diff = File.fetch_or_create(pickle.dumps(unit),
-                                                     base_file_path)
-        return False
-    return True
+    actual_output = actual_output or ''
+    if not coarse:
+        if cpu_limit:
+            signal.setitimer(signal.ITIMER_PROF, cpu_limit)
+        try:
+            unit = Diff(expected_output, actual_output)
+        except DiffTimeout:
+            coarse = True
+        finally:
+            if cpu_limit:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+    if coarse:
+        unit = Diff(expected_output, actual_output, coarse=True)
+    if unit.outputs_match():
+        return None, coarse
+    return unit.serialize(*pair), coarse
+
+
+class DiffPool(object):
+
+    """Compute diffs in a bounded pool of processes.
+
+    Each diff is given a budget of CPU time after which a coarse diff is used
+    so that no output can hold up the proxy. Without any processes the diffs
+    are computed inline.
+
+    """
+
+    # Guards against results lost with a pool process
+    WAIT_TIMEOUT = 120
+
+    def __init__(self, processes, cpu_limit):
+        self.processes = processes
+        self.cpu_limit = cpu_limit
+        self.pool = None
+
+    def start(self):
+        # The processes are forked on demand after daemonizing
+        if self.processes > 0 and self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes,
+                                             initializer=init_diff_process)
+
+    def submit(self, pair, expected_file, actual_output):
+        """Start the diff and return a function which waits for its result.
+
+        """
+        if self.pool is None:
+            result = make_diff(pair, expected_file, actual_output)
+            return lambda: result
+        pending = self.pool.apply_async(
+            make_diff, (pair, expected_file, actual_output, self.cpu_limit))
+
+        def wait():
+            try:
+                return pending.get(self.WAIT_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                return make_diff(pair, expected_file, actual_output,
+                                 coarse=True)
+        return wait
+
+
+def add_member(archive, name, data, mode=0o644):
+    """Add a file holding data to the tar archive."""
+    info = tarfile.TarInfo(name)
+    info.mode = mode
+    info.mtime = time.time()
+    info.size = len(data)
+    archive.addfile(info, BytesIO(data))
+
+
+class BuildCache(object):
+
+    """A cache of build outputs kept by the proxy.
+
+    Entries are keyed by the sha1 of the Makefile, the make target and the
+    names and sha1s of the source files (see `key`), thus a job is only sent
+    the build of sources identical to its own. Worker machines keep no
+    builds between jobs as the tests run with the same permissions as the
+    worker. Each entry is a single archive of the make output and every file
+    make created or changed. Entries are published with an atomic rename and
+    the least recently used are removed once the cache grows beyond
+    `max_size` bytes.
+
+    """
+
+    META_FILE = 'meta.json'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(manifest, target):
+        src = sorted((name, sha1) for name, sha1 in manifest.items()
+                     if name.startswith('src' + os.sep))
+        return sha1_hash(json.dumps([manifest.get('Makefile'), target, src],
+                                    sort_keys=True)).hexdigest()
+
+    def fetch(self, key, destination):
+        """Extract the entry's files into destination.
+
+        Return the entry's metadata, which holds the sha1 of each file, or
+        None when there is no entry.
+
+        """
+        path = os.path.join(self.path, key)
+        try:
+            archive = tarfile.open(path)
+        except (IOError, tarfile.TarError):
+            return None
+        with closing(archive):
+            meta = json.load(archive.extractfile(self.META_FILE))
+            for name in meta['files']:
+                member = archive.getmember('files/' + name)
+                dst = os.path.join(destination, name)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                with open(dst, 'wb') as fp:
+                    fp.write(archive.extractfile(member).read())
+                os.chmod(dst, member.mode)
+        try:
+            os.utime(path, None)  # Mark as recently used
+        except OSError:  # Evicted meanwhile
+            pass
+        return meta
+
+    def store(self, key, read):
+        """Store the build a worker returned, if any, as the entry for key.
+
+        `read` returns the contents of the named result file of the testable,
+        or None when the file does not exist.
+
+        """
+        data = read('build.json')
+        if data is None:
+            return
+        build = json.loads(data)
+        meta = {'duration': build['duration'], 'files': {},
+                'output': build['output']}
+        tmp = tempfile.NamedTemporaryFile(dir=self.path, prefix='.tmp',
+                                          delete=False)
+        try:
+            with closing(tarfile.open(fileobj=tmp, mode='w')) as archive:
+                for name, mode in build['files'].items():
+                    if os.path.isabs(name) or os.path.normpath(name) \
+                            .startswith(os.pardir):
+                        raise ValueError('Invalid build file: ' + name)
+                    content = read('build/' + name)
+                    if content is None:
+                        raise ValueError('Missing build file: ' + name)
+                    meta['files'][name] = sha1_hash(content).hexdigest()
+                    add_member(archive, 'files/' + name, content,
+                               mode & 0o755)
+                add_member(archive, self.META_FILE, json.dumps(meta))
+            tmp.close()
+            os.rename(tmp.name, os.path.join(self.path, key))
+        finally:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        prune_files(self.path, self.max_size)
+
+
+RESULTS_ARCHIVE = 'results.tar.gz'
+
+
+class JobResults(object):
+
+    """The result files of a job held in memory, keyed by their path."""
+
+    def __init__(self):
+        self.files = {}
+
+    def read(self, name):
+        """Return the contents of the result file name, or None."""
+        return self.files.get(name)
+
+
+class DirectoryResults(JobResults):
+
+    """Read the job's results from the directory they were rsynced to.
+
+    Only the results directories are read, allowing the job directory to be
+    removed before the results are stored.
+
+    """
+
+    method = 'rsync'
+
+    def __init__(self, path):
+        super(DirectoryResults, self).__init__()
+        for name in os.listdir(path):
+            results_path = os.path.join(path, name, 'results')
+            for dirpath, _, filenames in os.walk(results_path):
+                for filename in filenames:
+                    file_path = os.path.join(dirpath, filename)
+                    with open(file_path, 'rb') as fp:
+                        self.files[os.path.relpath(file_path, path)] = \
+                            fp.read()
+
+
+class ArchiveResults(JobResults):
+
+    """Read the job's results from the archive packed by the worker.
+
+    The gzip compressed tar archive is read entirely in memory, its members
+    are indexed by name and nothing is written to disk.
+
+    """
+
+    method = 'archive'
+
+    def __init__(self, data):
+        super(ArchiveResults, self).__init__()
+        with closing(tarfile.open(fileobj=BytesIO(data),
+                                  mode='r:gz')) as archive:
+            for member in archive.getmembers():
+                if member.isfile():
+                    self.files[member.name] = \
+                        archive.extractfile(member).read()
+
+
+class WorkerDaemonConnection(object):
+
+    """A persistent `worker.py --daemon` session on a worker machine.
+
+    Requests are sent over the stdin and stdout of a single long-lived SSH
+    session, thus connection setup and interpreter startup only occur once per
+    machine rather than once per job.
+
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+        self._buffer = ''
+
+    def close(self):
+        if self.proc:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        self._buffer = ''
+
+    def request(self, action, timeout=None, **kwargs):
+        """Send a request and return the daemon's response.
+
+        Raise SSHConnectTimeout when the daemon cannot be reached, or does not
+        respond within `timeout` seconds.
+
+        """
+        if not self.proc or self.proc.poll() is not None:
+            self.close()
+            self.proc = subprocess.Popen(
+                self.command, shell=True, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        kwargs['action'] = action
+        try:
+            self.proc.stdin.write(json.dumps(kwargs) + '\n')
+            self.proc.stdin.flush()
+            return json.loads(self._readline(timeout))
+        except (IOError, OSError, ValueError, SSHConnectTimeout):
+            self.close()
+            raise SSHConnectTimeout()
+
+    def _readline(self, timeout):
+        fd = self.proc.stdout.fileno()
+        end = time.time() + timeout if timeout else None
+        while '\n' not in self._buffer:
+            remaining = end - time.time() if end else None
+            if remaining is not None and remaining <= 0:
+                raise SSHConnectTimeout()
+            if not select.select([fd], [], [], remaining)[0]:
+                raise SSHConnectTimeout()
+            data = os.read(fd, 8192)
+            if not data:  # The connection was closed
+                raise SSHConnectTimeout()
+            self._buffer += data
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line
+
+
+class Slot(object):
+
+    """The health and latency statistics of one account on one machine."""
+
+    def __init__(self, machine, account):
+        self.machine = machine
+        self.account = account
+        self.busy = False
+        self.duration = None  # EWMA of the job duration in seconds
+        self.failure_rate = 0.  # EWMA of the job failures
+        self.failures = 0  # Consecutive failures
+        self.trips = 0  # Consecutive times the circuit was opened
+        self.disabled_until = None
+        self.last_seen = None
+
+    def __str__(self):
+        return '{}@{}'.format(self.account, self.machine)
+
+
+class Scheduler(object):
+
+    """A thread-safe scheduler of jobs onto (machine, account) slots.
+
+    Each account runs at most one job on a machine at a time as a job takes
+    over the account's home directory and processes on that machine. Among the
+    free slots the one with the lowest expected cost is chosen, where the cost
+    is the slot's EWMA job duration scaled up by its failure rate and by the
+    number of jobs already running on the machine.
+
+    After `circuit_failures` consecutive failures a slot is taken out of
+    rotation for `circuit_cooldown` seconds, doubling each time it fails again
+    once re-admitted. At most `max_per_machine` jobs (0 for no limit) run on a
+    single machine at a time.
+
+    """
+
+    ALPHA = 0.3
+    DEFAULT_DURATION = 5.
+    MAX_COOLDOWN = 3600
+
+    def __init__(self, machines, accounts, max_per_machine=0,
+                 circuit_failures=3, circuit_cooldown=60):
+        self.condition = threading.Condition()
+        self.slots = [Slot(machine, account) for machine in machines
+                      for account in accounts]
+        self.in_flight = {machine: 0 for machine in machines}
+        self.max_per_machine = max_per_machine
+        self.circuit_failures = circuit_failures
+        self.circuit_cooldown = circuit_cooldown
+
+    def acquire(self, key):
+        """Block until a slot is available and return it."""
+        with self.condition:
+            while True:
+                now = time.time()
+                best = None
+                candidates = 0
+                readmit_at = None
+                for slot in self.slots:
+                    if slot.busy or self.machine_full(slot.machine):
+                        continue
+                    if slot.disabled_until:
+                        if slot.disabled_until > now:
+                            readmit_at = min(readmit_at or slot.disabled_until,
+                                             slot.disabled_until)
+                            continue
+                        workers.log_msg('scheduler: readmitting {}'
+                                        .format(slot))
+                        slot.disabled_until = None
+                        # A single failure takes the slot out again
+                        slot.failures = self.circuit_failures - 1
+                    candidates += 1
+                    cost = self.cost(slot)
+                    # Break ties randomly to spread load across equal slots
+                    if best is None or (cost, random.random()) < best[:2]:
+                        best = (cost, random.random(), slot)
+                if best:
+                    break
+                self.condition.wait(readmit_at - now if readmit_at else None)
+            cost, _, slot = best
+            slot.busy = True
+            self.in_flight[slot.machine] += 1
+            workers.log_msg(
+                '{} placed on {} (cost {:.2f}, duration {}, failure rate '
+                '{:.2f}, in flight {}, candidates {})'.format(
+                    key, slot, cost, '{:.2f}'.format(slot.duration)
+                    if slot.duration is not None else '?', slot.failure_rate,
+                    self.in_flight[slot.machine] - 1, candidates))
+            return slot
+
+    def cost(self, slot):
+        duration = slot.duration
+        if duration is None:  # Try unknown slots early
+            duration = self.DEFAULT_DURATION
+        return (duration * (1 + self.in_flight[slot.machine]) /
+                max(0.05, 1 - slot.failure_rate))
+
+    def machine_full(self, machine):
+        return (self.max_per_machine > 0 and
+                self.in_flight[machine] >= self.max_per_machine)
+
+    def release(self, slot, duration, failed):
+        """Return `slot` and record the outcome of the job run on it.
+
+        `duration` is only given for jobs that completed.
+
+        """
+        with self.condition:
+            slot.busy = False
+            self.in_flight[slot.machine] -= 1
+            slot.failure_rate += self.ALPHA * (float(failed) -
+                                               slot.failure_rate)
+            if failed:
+                slot.failures += 1
+                if slot.failures >= self.circuit_failures:
+                    cooldown = min(self.MAX_COOLDOWN,
+                                   self.circuit_cooldown * 2 ** slot.trips)
+                    slot.trips += 1
+                    slot.failures = 0
+                    slot.disabled_until = time.time() + cooldown
+                    workers.log_msg('scheduler: disabling {} for {} seconds '
+                                    '(failure rate {:.2f})'.format(
+                                        slot, cooldown, slot.failure_rate))
+            else:
+                slot.last_seen = time.time()
+                slot.failures = slot.trips = 0
+            if duration is not None:
+                if slot.duration is None:
+                    slot.duration = duration
+                else:
+                    slot.duration += self.ALPHA * (duration - slot.duration)
+            self.condition.notify_all()
 
 
 class WorkerProxy():
+    HEARTBEAT_INTERVAL = 5  # Seconds between servicing the connection
+    RECONNECT_INTERVAL = 1  # Seconds before reconnecting to the queue server
+
     def __init__(self):
         parser = amqp_worker.base_argument_parser()
-        parser.add_argument('worker_account', type=str)
+        parser.add_argument('worker_account', type=str,
+                            help='comma separated list of worker accounts')
         args, settings = amqp_worker.parse_base_args(parser, 'app:main')
 
         self.base_file_path = settings['file_directory']
+        self.concurrency = int(settings.get('worker_concurrency', 1))
+        self.build_cache = None
+        if settings.get('worker_build_cache'):
+            self.build_cache = BuildCache(
+                os.path.abspath(settings['worker_build_cache']),
+                int(settings.get('worker_build_cache_size', 512)) *
+                1024 * 1024)
+        self.blob_cache_size = int(settings.get('worker_blob_cache_size',
+                                                2048)) * 1024 * 1024
         self.private_key_file = settings['ssh_priv_key']
-        self.account = args.worker_account
+        self.accounts = [x.strip() for x in args.worker_account.split(',')
+                         if x.strip()]
+        self.name = '_'.join(self.accounts)
+        self.use_daemon = asbool(settings.get('worker_daemon', False))
+        self.use_result_cache = asbool(settings.get('worker_result_cache',
+                                                    True))
+        self.use_results_archive = asbool(settings.get(
+            'worker_results_archive', True))
+        self.lazy_diffs = asbool(settings.get('worker_lazy_diffs', False))
+        self.threads = int(settings.get('worker_proxy_threads', 2))
+        self.queue_server = settings['queue_server']
+        self.queues = settings['queue_tell_worker']
+        if isinstance(self.queues, basestring):
+            self.queues = self.queues.split()
+        self.error_queue = settings.get('queue_tell_worker_error')
+        self.metrics_file = settings.get('worker_proxy_metrics_file')
+        if self.metrics_file:
+            self.metrics_file = os.path.abspath(
+                self.metrics_file.format(self.name))
+        self.metrics_lock = threading.Lock()
+        self.build_cache_stats = {'hits': 0, 'misses': 0, 'saved': 0.}
+        self.diff_cache_stats = {'hits': 0, 'misses': 0}
+        self.control_path = os.path.join(tempfile.mkdtemp(), '%r@%h:%p')
+        self.daemons = {}
+        self.consumers = None
+        self.diff_pool = DiffPool(
+            int(settings.get('worker_diff_processes', 2)),
+            float(settings.get('worker_diff_cpu_limit', 4)))
         machines = settings['worker_machines']
         if isinstance(machines, basestring):
             machines = [machines]
         random.shuffle(machines)
-        self.machines = [(5., x) for x in machines]
+        self.scheduler = Scheduler(
+            machines, self.accounts,
+            max_per_machine=int(settings.get('worker_max_jobs_per_machine',
+                                             0)),
+            circuit_failures=int(settings.get('worker_circuit_failures', 3)),
+            circuit_cooldown=int(settings.get('worker_circuit_cooldown', 60)))
         engine = engine_from_config(settings, 'sqlalchemy.')
         configure_sql(engine)
 
         worker = amqp_worker.AMQPWorker(
             settings['queue_server'], settings['queue_tell_worker'],
             self.do_work, is_daemon=args.daemon,
-            error_queue=settings.get('queue_tell_worker_error'),
-            log_file=settings['worker_proxy_log_file'].format(self.account),
-            pid_file=settings['worker_proxy_pid_file'].format(self.account),
-            email_subject='WorkerProxy {} Exception'.format(self.account),
+            error_queue=self.error_queue,
+            log_file=settings['worker_proxy_log_file'].format(self.name),
+            pid_file=settings['worker_proxy_pid_file'].format(self.name),
+            email_subject='WorkerProxy {} Exception'.format(self.name),
             email_from=settings['exc_mail_from'],
             email_to=settings['exc_mail_to'])
 
         worker.handle_command(args.command)
 
-    @workers.wrapper
-    def do_work(self, submission_id, testable_id, update_project=False):
+    def do_work(self, **message):
+        """Run the job described by `message`.
+
+        The message is acknowledged once this returns. With
+        `worker_proxy_threads` greater than one, the remaining threads each
+        fetch and run jobs over their own connection (see `consume_jobs`).
+
+        """
+        self.diff_pool.start()
+        if self.threads > 1 and self.consumers is None:
+            self.start_threads()
+        return self.run_job(**message)
+
+    def start_threads(self):
+        # Threads do not survive daemonizing and are thus started on demand
+        self.consumers = []
+        for _ in range(self.threads - 1):
+            thread = threading.Thread(target=self.consume_jobs)
+            thread.daemon = True
+            thread.start()
+            self.consumers.append(thread)
+
+    def consume_jobs(self):
+        """Consume and run jobs over this thread's own channel.
+
+        With a prefetch count of one the thread holds at most one
+        unacknowledged message, which is only acknowledged after its job
+        completed, thus the jobs of a proxy that dies are redelivered.
+        Failures are logged and the message is published to the error queue.
+
+        """
+        while True:
+            try:
+                conn = pika.BlockingConnection(
+                    pika.ConnectionParameters(host=self.queue_server))
+                try:
+                    channel = conn.channel()
+                    channel.basic_qos(prefetch_count=1)
+                    for queue in self.queues:
+                        channel.basic_consume(
+                            functools.partial(self.consume_message, conn),
+                            queue=queue)
+                    channel.start_consuming()
+                finally:
+                    conn.close()
+            except Exception:
+                workers.log_msg('Consuming from {} failed\n{}'.format(
+                    self.queue_server, traceback.format_exc()))
+                time.sleep(self.RECONNECT_INTERVAL)
+
+    def consume_message(self, conn, channel, method, _, body):
+        # Run the job in its own thread and keep servicing the connection
+        # meanwhile so that its heartbeats do not lapse during long jobs
+        job = threading.Thread(target=self.run_message,
+                               args=(json.loads(body),))
+        job.start()
+        while job.is_alive():
+            conn.process_data_events()
+            job.join(self.HEARTBEAT_INTERVAL)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def run_message(self, message):
+        try:
+            self.run_job(**message)
+        except HandledError as exc:  # Retrying will not help
+            workers.log_msg('{}.{} rejected: {}'.format(
+                message.get('submission_id'), message.get('testable_id'),
+                exc))
+        except Exception:
+            workers.log_msg('{}.{} failed\n{}'.format(
+                message.get('submission_id'), message.get('testable_id'),
+                traceback.format_exc()))
+            self.publish_error(message)
+        finally:
+            Session.remove()
+
+    def publish_error(self, message):
+        if not self.error_queue:
+            return
+        try:
+            conn = pika.BlockingConnection(
+                pika.ConnectionParameters(host=self.queue_server))
+            try:
+                conn.channel().basic_publish(
+                    exchange='', body=json.dumps(message),
+                    routing_key=self.error_queue,
+                    properties=pika.BasicProperties(delivery_mode=2))
+            finally:
+                conn.close()
+        except Exception:
+            workers.log_msg('Could not publish to {}\n{}'.format(
+                self.error_queue, traceback.format_exc()))
+
+    def run_job(self, submission_id, testable_id=None, testable_ids=None,
+                update_project=False, force=False, queued_at=None):
+        """Run the job and record the time spent in each of its stages.
+
+        A job covers either a single testable (`testable_id`) or a batch of a
+        submission's testables (`testable_ids`) which are all run in a single
+        round-trip to one worker machine.
+
+        """
+        if testable_ids is None:
+            testable_ids = [testable_id]
+        timer = workers.StageTimer()
+        if queued_at:
+            timer.add('queue', max(0, time.time() - queued_at))
+        metrics = {'key': '{}.{}'.format(submission_id, ','.join(
+            str(x) for x in testable_ids)), 'status': 'exception',
+            'update_project': update_project}
+        try:
+            metrics['status'] = self.process_job(
+                metrics, timer, submission_id, testable_ids, update_project,
+                force)
+            with timer('commit'):
+                transaction.commit()
+        except Exception:
+            transaction.abort()
+            raise
+        finally:
+            metrics['stages'] = timer.stages
+            workers.log_msg('{} stages: {}'.format(metrics['key'], timer))
+            self.record_metrics(metrics)
+
+    def record_build_cache(self, key, hit, saved):
+        """Update and log the running build cache hit rate."""
+        with self.metrics_lock:
+            stats = self.build_cache_stats
+            stats['hits' if hit else 'misses'] += 1
+            stats['saved'] += saved
+            total = stats['hits'] + stats['misses']
+            workers.log_msg('{} build cache {} (hit rate {:.1%} of {}, {:.1f} '
+                            'seconds saved)'.format(
+                                key, 'hit' if hit else 'miss',
+                                stats['hits'] / float(total), total,
+                                stats['saved']))
+
+    def record_diff_cache(self, key, hits, misses):
+        """Update and log the running diff cache hit rate."""
+        with self.metrics_lock:
+            stats = self.diff_cache_stats
+            stats['hits'] += hits
+            stats['misses'] += misses
+            total = stats['hits'] + stats['misses']
+            workers.log_msg('{} diff cache {} hits, {} misses (hit rate '
+                            '{:.1%} of {})'.format(
+                                key, hits, misses,
+                                stats['hits'] / float(total), total))
+
+    def record_metrics(self, metrics):
+        """Append the metrics as a line of JSON to the metrics file."""
+        if not self.metrics_file:
+            return
+        metrics['time'] = time.time()
+        line = json.dumps(metrics, sort_keys=True) + '\n'
+        with self.metrics_lock:
+            with open(self.metrics_file, 'a') as fp:
+                fp.write(line)
+
+    def process_job(self, metrics, timer, submission_id, testable_ids,
+                    update_project, force):
+        """Process the job and return how it completed."""
         # Verify job
         submission = Submission.fetch_by_id(submission_id)
         if not submission:
             raise HandledError('Invalid submission id: {0}'
                                .format(submission_id))
-        testable = Testable.fetch_by_id(testable_id)
-        if not testable:
-            raise HandledError('Invalid testable id: {0}'.format(testable_id))
         if update_project and submission.project.status != u'locked':
             raise HandledError('Rejecting update to unlocked project: {0}'
                                .format(submission.project.id))
-        if update_project and not testable.is_locked:
-            raise HandledError('Rejecting update to unlocked testable: {0}'
-                               .format(testable_id))
+        testables = []
+        for testable_id in testable_ids:
+            testable = Testable.fetch_by_id(testable_id)
+            if not testable:
+                raise HandledError('Invalid testable id: {0}'
+                                   .format(testable_id))
+            if update_project and not testable.is_locked:
+                raise HandledError('Rejecting update to unlocked testable: {0}'
+                                   .format(testable_id))
+            testables.append(testable)
 
+        # Reuse the results of earlier runs with identical inputs
+        input_digests = {}
+        if not update_project:
+            with timer('cache'):
+                for testable in list(testables):
+                    input_digest = testable.input_digest(submission)
+                    input_digests[testable.id] = input_digest
+                    if not self.use_result_cache or force or \
+                            not input_digest:
+                        continue
+                    cached = TestableResult.fetch_cached(
+                        testable, input_digest, submission)
+                    if cached:
+                        self.clone_results(cached, submission, testable)
+                        testables.remove(testable)
+                        workers.log_msg('{}.{} cached (from {})'.format(
+                            submission_id, testable.id,
+                            cached.submission_id))
+            if not testables:
+                submission.refresh_score()
+                GroupScore.refresh(submission.group)
+                return 'cached'
+
+        key = metrics['key']
         attempt = 0
         while attempt < 16:
             # Fetch the best machine
-            priority, machine = heappop(self.machines)
+            with timer('machine'):
+                slot = self.scheduler.acquire(key)
+            machine, account = slot.machine, slot.account
+            metrics['machine'] = str(slot)
             # Log the start of the job
-            workers.log_msg('{}.{} begin ({})'
-                            .format(submission_id, testable_id, machine))
+            workers.log_msg('{} begin ({})'.format(key, slot))
             log_type = 'unhandled'
+            failed = True
+            start = time.time()
             try:
-                # Kill any processes on the worker
-                priority = self.kill_processes(machine)
-                # Copy the files to the worker (and remove existing files)
-                self.push_files(machine, submission, testable)
-                # Run the remote worker
-                self.ssh(machine, 'python worker.py')
-                # Fetch and generate the results
-                self.fetch_results(machine, submission, testable,
-                                   update_project)
+                with workers.job_directory() as path:
+                    # Kill any processes on the worker
+                    with timer('kill'):
+                        self.kill_processes(machine, account)
+                    # Copy the files to the worker (and remove existing files)
+                    with timer('push'):
+                        build_keys = self.push_files(
+                            machine, account, submission, testables, path,
+                            update_project)
+                    # Run the remote worker
+                    with timer('run'):
+                        self.run_worker(machine, account)
+                    # Fetch the results
+                    results = self.fetch_results(machine, account, path,
+                                                 metrics, timer)
                 log_type = 'success'
-                return
+                failed = False
+                break
             except SSHConnectTimeout:  # Retry with a different host
                 attempt += 1
+                metrics['attempts'] = attempt
                 log_type = 'timeout'
-                priority += 10
-            except Exception:  # Increase priority and rereaise the exception
+            except HandledError:  # Not the machine's fault
+                log_type = 'exception'
+                failed = False
+                raise
+            except Exception:  # Penalize the machine and rereaise
                 log_type = 'exception'
-                priority += 5
                 raise
             finally:
-                # Add the machine back to the queue
-                heappush(self.machines, (priority, machine))
+                # Return the machine to the scheduler
+                duration = time.time() - start
+                self.scheduler.release(slot, duration if log_type == 'success'
+                                       else None, failed)
                 # Log the end of the job
-                workers.log_msg('{}.{} {} ({})'.format(submission_id,
-                                                       testable_id, log_type,
-                                                       machine))
-        raise Exception('{}.{} timed out 16 times.'
-                        .format(submission_id, testable_id))
+                workers.log_msg('{} {} ({})'.format(key, log_type, slot))
+        else:
+            raise Exception('{} timed out 16 times.'.format(key))
+
+        # The machine is free to take the next job, run by another proxy
+        # thread (see `worker_proxy_threads`), while the results, and their
+        # diffs, are stored
+        metrics['worker'] = {}
+        metrics['diffs'] = {'coarse': 0, 'count': 0, 'deferred': 0}
+        metrics['diff_cache'] = {'hits': 0, 'misses': 0}
+        for testable in testables:
+            prefix = 't_{}/results/'.format(testable.id)
+
+            def read(name, prefix=prefix):
+                return results.read(prefix + name)
+
+            if self.build_cache and testable.id in build_keys:
+                self.store_build(build_keys[testable.id], read)
+            self.ingest_results(submission, testable, update_project, read,
+                                metrics, timer, input_digests.get(testable.id))
+        if sum(metrics['diff_cache'].values()):
+            self.record_diff_cache(key, **metrics['diff_cache'])
+        if not update_project:
+            with timer('scores'):
+                submission.refresh_score()
+                GroupScore.refresh(submission.group)
+        return log_type
+
+    def clone_results(self, cached, submission, testable):
+        """Copy the results in `cached` to the submission."""
+        existing = TestCaseResult.fetch_by_testable(submission.id, testable)
+        points = 0
+        for source in TestCaseResult.fetch_by_testable(
+                cached.submission_id, testable).values():
+            data = {'cpu_sys': source.cpu_sys, 'cpu_user': source.cpu_user,
+                    'diff': source.diff, 'extra': source.extra,
+                    'max_rss': source.max_rss, 'output': source.output,
+                    'output_matches': source.output_matches,
+                    'status': source.status, 'wall_time': source.wall_time}
+            test_case_result = existing.pop(source.test_case_id, None)
+            if test_case_result:
+                test_case_result.update(data)
+            else:
+                Session.add(TestCaseResult(submission_id=submission.id,
+                                           test_case_id=source.test_case_id,
+                                           **data))
+            test_case = source.test_case
+            if test_case.output_type == 'diff' and source.outputs_match() \
+                    and source.status == 'success':
+                points += test_case.points
+        for test_case_result in existing.values():
+            Session.delete(test_case_result)
+        result = TestableResult.fetch_or_create(
+            make_results=cached.make_results, points=points,
+            status=cached.status, testable=testable, submission=submission)
+        result.input_digest = cached.input_digest
+
+    def store_build(self, key, read):
+        """Add the build the worker returned, if any, to the build cache."""
+        try:
+            self.build_cache.store(key, read)
+        except Exception:  # The cache is only an optimization
+            workers.log_msg('Storing build {} failed\n{}'.format(
+                key, traceback.format_exc()))
+
+    def fetch_results(self, machine, account, path, metrics, timer):
+        """Retrieve the results of every testable in the job.
 
-    def fetch_results(self, machine, submission, testable, update_project):
-        # Rsync to retrieve results
-        self.rsync(machine)
-        os.chdir('results')
+        All the results are retrieved in a single transfer.
+
+        """
+        start = time.time()
+        with timer('fetch'):
+            if self.use_results_archive:
+                data = self.ssh(machine, account,
+                                'cat working/{}'.format(RESULTS_ARCHIVE))
+                num_bytes = len(data)
+                reader = ArchiveResults(data)
+            else:
+                num_bytes = self.rsync(machine, account, path)
+                reader = DirectoryResults(path)
+        metrics['transfer'] = {'bytes': num_bytes, 'method': reader.method,
+                               'seconds': time.time() - start}
+        workers.log_msg('{} fetched {} bytes via {} in {:.3f} seconds'.format(
+            metrics['key'], num_bytes, reader.method,
+            metrics['transfer']['seconds']))
+        return reader
+
+    def ingest_results(self, submission, testable, update_project, read,
+                       metrics, timer, input_digest):
+        """Store the results of a single testable.
+
+        `read` returns the contents of the named result file of the testable,
+        or None when the file does not exist.
+
+        """
+        # Include the worker's own timings in the metrics
+        timings = read('timings')
+        if timings is not None:
+            timings = metrics['worker'][testable.id] = json.loads(timings)
+            if 'build_cache' in timings:
+                self.record_build_cache(
+                    '{}.{}'.format(submission.id, testable.id),
+                    **timings['build_cache'])
 
         # Create dictionary of completed test_cases
-        if os.path.isfile('test_cases'):
-            with open('test_cases') as fp:
-                results = {int(x[0]): x[1] for x in json.load(fp).items()}
+        test_cases = read('test_cases')
+        if test_cases is not None:
+            results = {int(x[0]): x[1] for x in json.loads(test_cases).items()}
         else:
             results = {}
 
         if update_project:
-            set_expected_files(testable, results, self.base_file_path)
+            set_expected_files(testable, results, self.base_file_path, read)
             return
 
+        start = time.time()
         points = 0
 
-        # Set or update relevant test case results
+        # Set or update relevant test case results using the results that
+        # were loaded in a single query
+        existing = TestCaseResult.fetch_by_testable(submission.id, testable)
+        added = []
+        diffs = {}
         for test_case in testable.test_cases:
-            test_case_result = TestCaseResult.fetch_by_ids(submission.id,
-                                                           test_case.id)
+            test_case_result = existing.get(test_case.id)
             if test_case.id not in results:
                 if test_case_result:  # Delete existing result
                     Session.delete(test_case_result)
+                continue
+            # The worker drops outputs that match the expected output
+            matches = results[test_case.id].pop('matches', False)
+            if test_case_result:
+                test_case_result.update(results[test_case.id])
             else:
-                if test_case_result:
-                    test_case_result.update(results[test_case.id])
-                else:
-                    results[test_case.id]['submission_id'] = submission.id
-                    results[test_case.id]['test_case_id'] = test_case.id
-                    test_case_result = TestCaseResult(**results[test_case.id])
-                    Session.add(test_case_result)
-                output_file = 'tc_{0}'.format(test_case.id)
-                if test_case.output_type == 'diff':
-                    matches = compute_diff(test_case, test_case_result,
-                                           output_file, self.base_file_path)
-                    if matches and test_case_result.status == 'success':
+                results[test_case.id]['submission_id'] = submission.id
+                results[test_case.id]['test_case_id'] = test_case.id
+                test_case_result = TestCaseResult(**results[test_case.id])
+                added.append(test_case_result)
+            output = read('tc_{0}'.format(test_case.id))
+            if test_case.output_type == 'diff':
+                test_case_result.diff = test_case_result.output = None
+                if not matches:
+                    pair = (test_case.expected.sha1,
+                            sha1_hash(output or '').hexdigest())
+                    matches = pair[0] == pair[1]
+                test_case_result.output_matches = matches
+                if matches:
+                    if test_case_result.status == 'success':
                         points += test_case.points
-                else:
-                    if os.path.isfile(output_file):  # Store file as the diff
-                        test_case_result.diff = File.fetch_or_create(
-                            open(output_file).read(), self.base_file_path)
+                    continue
+                # Reuse the diff of an identical pair of outputs
+                cached = DiffCache.fetch(*pair)
+                if cached:
+                    metrics['diff_cache']['hits'] += 1
+                    test_case_result.diff = cached.diff
+                    continue
+                metrics['diff_cache']['misses'] += 1
+                # Diffs reference the lines of the stored output
+                test_case_result.output = File.fetch_or_create(
+                    output or '', self.base_file_path)
+                if self.lazy_diffs:  # Diffed when the result is first viewed
+                    metrics['diffs']['deferred'] += 1
+                    continue
+                if pair not in diffs:
+                    diffs[pair] = (self.diff_pool.submit(pair, File.file_path(
+                        self.base_file_path, pair[0]), output), [])
+                diffs[pair][1].append(test_case_result)
+            else:
+                if output is not None:  # Store file as the diff
+                    test_case_result.diff = File.fetch_or_create(
+                        output, self.base_file_path)
+        Session.add_all(added)
+
+        # Wait for the diffs of the test cases whose output was not matched
+        # (the outputs differ so no diff is empty)
+        with timer('diff'):
+            for pair, (wait, test_case_results) in diffs.items():
+                data, coarse = wait()
+                metrics['diffs']['count'] += 1
+                metrics['diffs']['coarse'] += coarse
+                diff = File.fetch_or_create(data, self.base_file_path)
+                # Coarse diffs are retried by later submissions
+                if not coarse:
+                    DiffCache.store(pair[0], pair[1], diff)
+                for test_case_result in test_case_results:
+                    test_case_result.diff = diff
 
         # Create or update Testable
-        testable_data = json.load(open('testable'))
-        TestableResult.fetch_or_create(
+        testable_data = json.loads(read('testable'))
+        result = TestableResult.fetch_or_create(
             make_results=testable_data.get('make'), points=points,
             status=testable_data['status'], testable=testable,
             submission=submission)
+        # Timeouts depend on machine load, and signals often on timing, so
+        # those results are not reused
+        if any(x['status'] in ('signal', 'timed_out')
+               for x in results.values()):
+            input_digest = None
+        result.input_digest = input_digest
+        Session.flush()
+        # The ingest stage includes the time spent in the diff stage
+        timer.add('ingest', time.time() - start)
 
-    def kill_processes(self, machine):
+    def daemon(self, machine, account):
+        """Return the persistent daemon connection for `account@machine`."""
+        if (machine, account) not in self.daemons:
+            self.daemons[(machine, account)] = WorkerDaemonConnection(
+                self.ssh_command(machine, account,
+                                 'python worker.py --daemon'))
+        return self.daemons[(machine, account)]
+
+    def kill_processes(self, machine, account):
+        if self.use_daemon:
+            start = time.time()
+            self.daemon(machine, account).request('kill', timeout=16)
+            return time.time() - start
         expected = 'Connection to {} closed by remote host.'.format(machine)
         start = time.time()
         try:
-            self.ssh(machine, 'killall -9 -u {}'.format(self.account),
+            self.ssh(machine, account, 'killall -9 -u {}'.format(account),
                      timeout=1)
             raise Exception('killall did not work as expected')
         except subprocess.CalledProcessError as exc:
@@ -197,87 +1048,187 @@ class WorkerProxy():
                                 .format(exc.returncode, exc.output.strip()))
         return time.time() - start
 
-    def push_files(self, machine, submission, testable):
+    def push_files(self, machine, account, submission, testables, path,
+                   update_project):
+        """Copy the job's files to the worker machine.
+
+        The worker machine keeps a persistent cache of file contents in its
+        `blobs` directory, laid out like `File.file_path`. Only a manifest
+        mapping each path in the working directory to a sha1 is sent along
+        with the blobs the machine is missing, or whose contents changed. The
+        worker then materializes the working directory from its cache. The
+        tests can read the cache, thus submitted files are never cached and
+        are instead sent with every job.
+
+        Each testable of the job has its own `t_<testable_id>` directory
+        within the working directory.
+
+        Return the build key of each testable that runs make.
+
+        """
+        working_path = os.path.join(path, 'working')
+        os.mkdir(working_path)
+        sha1s = set()
+        build_keys = {}
+        for testable in testables:
+            testable_path = os.path.join(working_path,
+                                         't_{}'.format(testable.id))
+            os.mkdir(testable_path)
+            blobs, build_key = self.prepare_testable(
+                submission, testable, testable_path, update_project)
+            sha1s.update(blobs)
+            if build_key:
+                build_keys[testable.id] = build_key
+        with open(os.path.join(working_path, 'data.json'), 'w') as fp:
+            json.dump({'blob_cache_size': self.blob_cache_size,
+                       'key': '{}.{}'.format(submission.id, ','.join(
+                           str(x.id) for x in testables)),
+                       'pack_results': self.use_results_archive,
+                       'testables': [x.id for x in testables]}, fp)
+
+        # Symlink the blobs mirroring the worker's cache layout
+        blobs_path = os.path.join(path, 'blobs')
+        os.mkdir(blobs_path)
+        for sha1 in sha1s:
+            destination = File.file_path(blobs_path, sha1)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            os.symlink(File.file_path(self.base_file_path, sha1), destination)
+
+        # Rsync missing blobs and then the working directory
+        self.rsync_blobs(machine, account, path)
+        self.rsync(machine, account, path, from_local=True)
+        return build_keys
+
+    def prepare_testable(self, submission, testable, path, update_project):
+        """Save the testable's manifest and data specification in path.
+
+        Submitted files are symlinked into path to be sent with the job.
+        Unless the job updates the expected outputs, diff test cases include
+        the sha1 of their expected output so the worker can skip returning
+        outputs that match. A matching build from the build cache is
+        extracted into path's `build` directory.
+
+        Return a tuple of the sha1s of the files in the manifest that are
+        sent via the blob cache, and the build key (None without make).
+
+        """
         submitted = {x.filename: x.file.sha1 for x in submission.files}
         build_files = {x.filename: x.file.sha1 for x in testable.build_files}
+        manifest = {}
+        sent = set()  # Paths of the submitted files
 
-        # Prepare build directory by symlinking the relevant submission files
-        os.mkdir('src')
+        # Prepare build directory with the relevant submission files
         for filev in testable.file_verifiers:
             if filev.filename in submitted:
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, os.path.join('src', filev.filename))
+                manifest[os.path.join('src', filev.filename)] = \
+                    submitted[filev.filename]
+                sent.add(os.path.join('src', filev.filename))
                 if filev.filename in build_files:
                     del build_files[filev.filename]
             elif not filev.optional:
                 raise HandledError('File verifier not satisfied: {0}'
                                    .format(filev.filename))
-        for name, sha1 in build_files.items():  # Symlink remaining build files
-            source = File.file_path(self.base_file_path, sha1)
-            os.symlink(source, os.path.join('src', name))
+        for name, sha1 in build_files.items():  # Add remaining build files
+            manifest[os.path.join('src', name)] = sha1
 
-        # Symlink Makefile to current directory if necessary
+        # Add the Makefile to the working directory if necessary
         if submission.project.makefile and testable.make_target:
-            source = File.file_path(self.base_file_path,
-                                    submission.project.makefile.sha1)
-            os.symlink(source, 'Makefile')
+            manifest['Makefile'] = submission.project.makefile.sha1
 
-        # Symlink test inputs and copy build test case specifications
-        os.mkdir('inputs')
+        # Add test inputs and copy build test case specifications
         test_cases = []
         for test_case in testable.test_cases:
             test_cases.append(test_case.serialize())
+            if not update_project and test_case.output_type == 'diff' \
+                    and test_case.expected:
+                test_cases[-1]['expected_sha1'] = test_case.expected.sha1
             if test_case.stdin:
-                destination = os.path.join('inputs', test_case.stdin.sha1)
-                if not os.path.isfile(destination):
-                    source = File.file_path(self.base_file_path,
-                                            test_case.stdin.sha1)
-                    os.symlink(source, destination)
-
-        # Copy execution files
-        os.mkdir('execution_files')
+                manifest[os.path.join('inputs', test_case.stdin.sha1)] = \
+                    test_case.stdin.sha1
+
+        # Add execution files
         for execution_file in testable.execution_files:
-            destination = os.path.join('execution_files',
-                                       execution_file.filename)
-            source = File.file_path(self.base_file_path,
-                                    execution_file.file.sha1)
-            os.symlink(source, destination)
-        # Symlink sumbitted files that should be in the execution environment
+            manifest[os.path.join('execution_files',
+                                  execution_file.filename)] = \
+                execution_file.file.sha1
+        # Add sumbitted files that should be in the execution environment
         for filev in testable.file_verifiers:
             if filev.copy_to_execution and filev.filename in submitted:
-                destination = os.path.join('execution_files', filev.filename)
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, destination)
+                manifest[os.path.join('execution_files', filev.filename)] = \
+                    submitted[filev.filename]
+                sent.add(os.path.join('execution_files', filev.filename))
 
         # Generate data dictionary
-        data = {'executable': testable.executable,
+        data = {'concurrency': self.concurrency,
+                'executable': testable.executable,
                 'key': '{}.{}'.format(submission.id, testable.id),
                 'make_target': testable.make_target,
                 'test_cases': test_cases}
+        build_key = None
+        if testable.make_target:
+            build_key = data['build_key'] = BuildCache.key(
+                manifest, testable.make_target)
+            if self.build_cache:
+                data['build_cache'] = self.build_cache.fetch(
+                    build_key, os.path.join(path, 'build'))
+                data['return_build'] = not data['build_cache']
+
+        # Symlink the submitted files
+        blobs = set()
+        for name, sha1 in manifest.items():
+            if name not in sent:
+                blobs.add(sha1)
+                continue
+            destination = os.path.join(path, name)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            os.symlink(File.file_path(self.base_file_path, sha1), destination)
 
-        # Save data specification
-        with open('data.json', 'w') as fp:
+        # Save the manifest and data specification
+        with open(os.path.join(path, 'manifest.json'), 'w') as fp:
+            json.dump(manifest, fp)
+        with open(os.path.join(path, 'data.json'), 'w') as fp:
             json.dump(data, fp)
+        return blobs, build_key
 
-        # Rsync files
-        self.rsync(machine, from_local=True)
+    def run_worker(self, machine, account):
+        if not self.use_daemon:
+            self.ssh(machine, account, 'python worker.py')
+            return
+        response = self.daemon(machine, account).request('run')
+        if response['status'] != 'success':
+            raise Exception('Worker {} on {}@{} failed:\n{}'.format(
+                response['status'], account, machine,
+                response.get('output') or response.get('message')))
 
-    def rsync(self, machine, from_local=False):
-        src = '{}@{}:working/'.format(self.account, machine)
-        dst = '.'
+    def rsync(self, machine, account, path, from_local=False):
+        """Synchronize the working directory and return the bytes received.
+
+        """
+        src = '{}@{}:working/'.format(account, machine)
+        dst = path + os.sep
         if from_local:
-            src, dst = dst, src
-        cmd = ('rsync -e \'ssh -i {}\' --timeout=16 --delete -rLpv {} {}'
-               .format(self.private_key_file, src, dst))
+            src, dst = os.path.join(path, 'working') + os.sep, src
+        cmd = ('rsync -e \'ssh {}\' --timeout=16 --delete --stats -rLpv '
+               '{} {}'.format(self.ssh_options(), src, dst))
+        output = subprocess.check_output(cmd, shell=True)
+        match = re.search(r'Total bytes received: ([\d,]+)', output)
+        return int(match.group(1).replace(',', '')) if match else None
+
+    def rsync_blobs(self, machine, account, path):
+        """Transfer only the blobs that are missing from, or were modified
+        in, the machine's cache.
+
+        """
+        cmd = ('rsync -e \'ssh {}\' --timeout=16 --checksum -rLpv '
+               '{}/ {}@{}:blobs/'.format(self.ssh_options(),
+                                         os.path.join(path, 'blobs'),
+                                         account, machine))
         subprocess.check_call(cmd, stdout=open(os.devnull, 'w'), shell=True)
 
-    def ssh(self, machine, command, timeout=None):
-        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
-        cmd = 'ssh -i {key} {options} {user}@{host} {command}'.format(
-            key=self.private_key_file, user=self.account, host=machine,
-            command=command, options=options)
+    def ssh(self, machine, account, command, timeout=None):
+        cmd = self.ssh_command(machine, account, command, timeout)
         proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
                                 stdout=subprocess.PIPE)
         stdout, stderr = proc.communicate()
@@ -287,6 +1238,28 @@ class WorkerProxy():
             output = stdout + '\n' + stderr if stdout else stderr
             raise subprocess.CalledProcessError(proc.returncode, cmd,
                                                 output=output)
+        return stdout
+
+    def ssh_command(self, machine, account, command, timeout=None):
+        options = self.ssh_options()
+        if timeout:
+            options += ' -o ConnectTimeout={}'.format(timeout)
+        return 'ssh {options} {user}@{host} {command}'.format(
+            options=options, user=account, host=machine,
+            command=command)
+
+    def ssh_options(self):
+        """Return the options shared by every ssh (and rsync) invocation.
+
+        In daemon mode the connections to each machine are multiplexed over
+        a single persistent master connection.
+
+        """
+        options = '-i {}'.format(self.private_key_file)
+        if self.use_daemon:
+            options += (' -o ControlMaster=auto -o ControlPersist=600'
+                        ' -o ControlPath={}'.format(self.control_path))
+        return options
 
 
 def main():
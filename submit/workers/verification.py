@@ -1,19 +1,12 @@
 import amqp_worker
+import time
 from sqlalchemy import engine_from_config
 from .. import workers
 from ..models import Submission, configure_sql
 
-# Hack for old pickle files
-# TODO: Migrate this data to not use pickle
-import submit
-import sys
-sys.modules['nudibranch'] = submit
-sys.modules['nudibranch.diff_unit'] = submit.diff_unit
-sys.modules['nudibranch.models'] = submit.models
-
 
 @workers.wrapper
-def do_work(submission_id, update_project=False):
+def do_work(submission_id, update_project=False, force=False):
     submission = Submission.fetch_by_id(submission_id)
     if not submission:
         workers.log_msg('Invalid submission id: {0}'.format(submission_id))
@@ -43,9 +36,11 @@ def do_work(submission_id, update_project=False):
             break
     if valid_testables:
         workers.log_msg('Passed: {0}'.format(submission_id))
-        retval = [{'submission_id': submission_id, 'testable_id': x.id,
-                   'update_project': update_project}
-                  for x in valid_testables]
+        # A single job runs every testable in one worker round-trip
+        retval = [{'submission_id': submission_id,
+                   'testable_ids': sorted(x.id for x in valid_testables),
+                   'update_project': update_project, 'force': force,
+                   'queued_at': time.time()}]
     else:
         workers.log_msg('Failed: {0}'.format(submission_id))
         if update_project:
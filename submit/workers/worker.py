@@ -1,17 +1,25 @@
 #!/usr/bin/env python
+import argparse
 import errno
+import fcntl
+import functools
 import json
+import multiprocessing
 import os
+import resource
 import shlex
 import shutil
 import select
 import signal
 import socket
+import stat
 import sys
+import tarfile
 import tempfile
 import time
 import traceback
 from datetime import datetime
+from hashlib import sha1 as sha1_hash
 from subprocess import Popen, PIPE, STDOUT
 
 
@@ -19,15 +27,127 @@ SRC_PATH = 'src'
 INPUT_PATH = 'inputs'
 RESULTS_PATH = 'results'
 EXECUTION_FILES_PATH = 'execution_files'
+BUILD_PATH = 'build'  # A build sent from the proxy's build cache
+BLOBS_PATH = 'blobs'  # Relative to the home directory
+MANIFEST_FILE = 'manifest.json'
+RESULTS_ARCHIVE = 'results.tar.gz'
 
 MAX_FILE_SIZE = 81920
+MAX_BUILD_SIZE = 16777216  # Larger builds are neither reused nor returned
 TIME_LIMIT = 4
+# Bounds any single file a test writes, well above the output limits
+FILE_SIZE_BACKSTOP = 67108864
+SAVE_POLL_INTERVAL = 0.01  # Seconds between checks of a saved file's size
+
+BLOB_PRUNE_INTERVAL = 3600  # Seconds between walks of the blob cache
+
+FICLONE = 0x40049409  # From linux/fs.h
 
 # Prepare Child Environemtn to disable CCACHE
 CHILD_ENV = os.environ.copy()
 CHILD_ENV.update(CCACHE_DISABLE='1')
 
 
+def blob_path(home, sha1):
+    """Return the path to a cached blob (matches `File.file_path`)."""
+    return os.path.join(home, BLOBS_PATH, sha1[:2], sha1[2:4], sha1[4:])
+
+
+def copy_file(src, dst):
+    """Copy src to dst leaving dst writable (the source may be read-only)."""
+    shutil.copy(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+
+
+def file_sha1(path):
+    digest = sha1_hash()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot(path):
+    """Return a mapping of each file below path to its stat signature."""
+    retval = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            info = os.lstat(full_path)
+            retval[os.path.relpath(full_path, path)] = (
+                info.st_ino, info.st_size, info.st_mtime)
+    return retval
+
+
+def reflink_file(src, dst):
+    """Make dst a copy-on-write clone of src and return whether it worked.
+
+    Only some filesystems (e.g., btrfs and xfs) support cloning.
+
+    """
+    with open(src, 'rb') as src_fp:
+        with open(dst, 'wb') as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+            except (IOError, OSError):
+                return False
+    mode = stat.S_IMODE(os.stat(src).st_mode)
+    os.chmod(dst, mode | stat.S_IWUSR)
+    return True
+
+
+class Sandbox(object):
+
+    """Create the directories that test cases run within.
+
+    Each directory holds the execution files as copy-on-write clones when
+    the filesystem supports them, otherwise as plain copies. Every test case
+    thus gets its own writable execution files that no other test case can
+    see.
+
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.reflink = True
+
+    def create(self):
+        """Return the path to a new directory holding the execution files."""
+        tmp_dir = tempfile.mkdtemp()
+        for filename in os.listdir(self.source):
+            src = os.path.join(self.source, filename)
+            dst = os.path.join(tmp_dir, filename)
+            if not (self.reflink and reflink_file(src, dst)):
+                self.reflink = False
+                copy_file(src, dst)
+        return tmp_dir
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def reap(process, usage, start, options=0):
+    """Wait for process and record its resource usage in `usage`.
+
+    Return the process's returncode, or None when `options` contains
+    `os.WNOHANG` and the process is still running.
+
+    """
+    if process.returncode is not None:
+        return process.returncode
+    pid, status, rusage = os.wait4(process.pid, options)
+    if not pid:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    usage.update(cpu_sys=rusage.ru_stime, cpu_user=rusage.ru_utime,
+                 max_rss=rusage.ru_maxrss, wall_time=time.time() - start)
+    return process.returncode
+
+
 def log_msg(msg):
     print('{} {}'.format(datetime.now(), msg))
 
@@ -40,20 +160,114 @@ def alarm_handler(_, _a):
     raise TimeoutAlarm
 
 
+def prune_files(path, max_size):
+    """Remove the least recently used files until path holds max_size bytes.
+
+    Files whose name starts with a dot are left alone.
+
+    """
+    files = []
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            try:
+                info = os.stat(filepath)
+            except OSError:  # Removed by another job
+                continue
+            files.append((info.st_mtime, info.st_size, filepath))
+            total += info.st_size
+    for _, size, filepath in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.unlink(filepath)
+        except OSError:
+            continue
+        total -= size
+
+
+def prune_blobs(home, max_size):
+    """Evict the least recently used blobs once the cache exceeds max_size.
+
+    Blobs are touched whenever a job uses them. The cache is walked at most
+    once every BLOB_PRUNE_INTERVAL seconds as recorded by a marker file. The
+    proxy sends evicted blobs again when a later job needs them.
+
+    """
+    path = os.path.join(home, BLOBS_PATH)
+    marker = os.path.join(path, '.pruned')
+    if not os.path.isdir(path) or os.path.isfile(marker) and \
+            time.time() - os.path.getmtime(marker) < BLOB_PRUNE_INTERVAL:
+        return
+    with open(marker, 'w'):
+        pass
+    prune_files(path, max_size)
+
+
+def write_file(path, data, mode):
+    """Replace the file at path with one holding data."""
+    if os.path.lexists(path):
+        os.unlink(path)
+    elif not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    os.chmod(path, mode)
+
+
+def remove_tree(path):
+    """Remove path including any read-only files it contains."""
+    def make_writable(function, path, _):
+        os.chmod(os.path.dirname(path), 0o755)
+        function(path)
+    shutil.rmtree(path, onerror=make_writable)
+
+
 class Worker(object):
     @staticmethod
     def execute(command, stderr=None, stdin=None, stdout=None, files=None,
-                save=None):
-        if not stderr:
-            stderr = open('/dev/null', 'w')
-        if not stdout:
-            stdout = open('/dev/null', 'w')
+                save=None, usage=None, output_limit=None,
+                file_size_limit=None, sandbox=None):
+        """Run command and return its exit status.
+
+        When provided, the `usage` dictionary is updated with the CPU time,
+        wall time and peak resident set size (in kilobytes) of the process,
+        including when it is killed for exceeding its time limit.
+
+        The output kept (`stdout`, otherwise `stderr`) is pumped through a
+        pipe. Once it exceeds `output_limit` bytes the process group is killed
+        and OutputLimitExceeded is raised, leaving exactly `output_limit`
+        bytes in the output. When a file is kept instead (`save`), its size is
+        polled and the same happens once it exceeds `output_limit` bytes;
+        the caller truncates it. Other files the process writes are only
+        bounded by `file_size_limit`, via RLIMIT_FSIZE.
+
+        The process runs in a directory created by `sandbox` when provided,
+        otherwise by a new Sandbox of the execution files.
+
+        """
+        if usage is None:
+            usage = {}
+        devnull = open(os.devnull, 'w')
+        # Only the stream whose output is kept needs to be pumped
+        if stdout:
+            output, stdout, stderr = stdout, PIPE, stderr or devnull
+        elif stderr:
+            output, stdout, stderr = stderr, devnull, PIPE
+        else:
+            output, stdout, stderr = None, devnull, devnull
 
-        # Create temporary directory and copy execution files
-        tmp_dir = tempfile.mkdtemp()
-        for filename in os.listdir(EXECUTION_FILES_PATH):
-            shutil.copy(os.path.join(EXECUTION_FILES_PATH, filename),
-                        os.path.join(tmp_dir, filename))
+        def preexec():
+            os.setsid()
+            if file_size_limit:
+                resource.setrlimit(resource.RLIMIT_FSIZE,
+                                   (file_size_limit, file_size_limit))
+
+        # Create temporary directory with the execution files
+        tmp_dir = (sandbox or Sandbox(EXECUTION_FILES_PATH)).create()
 
         args = shlex.split(command)
         # allow some programs
@@ -69,7 +283,7 @@ class Worker(object):
             for arg in args:
                 src = os.path.join(SRC_PATH, arg)
                 if os.path.isfile(src):
-                    shutil.copy(src, os.path.join(tmp_dir, arg))
+                    copy_file(src, os.path.join(tmp_dir, arg))
 
         # Hacks to give more time to some scripts:
         time_limit = TIME_LIMIT
@@ -82,32 +296,63 @@ class Worker(object):
         # TODO: Do we only get partial output with stdout?
         try:
             poll = select.epoll()
-            main_pipe = Popen(args, stdin=stdin, stdout=PIPE, stderr=stderr,
-                              cwd=tmp_dir, preexec_fn=os.setsid,
-                              executable=executable, env=CHILD_ENV)
-            poll.register(main_pipe.stdout, select.EPOLLIN | select.EPOLLHUP)
-            do_poll = True
             start = time.time()
+            main_pipe = Popen(args, stdin=stdin, stdout=stdout, stderr=stderr,
+                              cwd=tmp_dir, preexec_fn=preexec,
+                              executable=executable, env=CHILD_ENV)
+            do_poll = output is not None
+            if do_poll:
+                poll.register(main_pipe.stdout or main_pipe.stderr,
+                              select.EPOLLIN | select.EPOLLHUP)
+            written = 0
             while do_poll:
                 remaining_time = start + time_limit - time.time()
                 if remaining_time <= 0:
-                    if main_pipe.poll() is None:  # Ensure it's still running
+                    # Ensure it's still running
+                    if reap(main_pipe, usage, start, os.WNOHANG) is None:
                         # Kill the entire process group
                         os.killpg(main_pipe.pid, signal.SIGKILL)
+                        reap(main_pipe, usage, start)
                         raise TimeoutException()
                 for file_descriptor, event in poll.poll(remaining_time):
-                    stdout.write(os.read(file_descriptor, 8192))
+                    data = os.read(file_descriptor, 8192)
+                    if output_limit and written + len(data) > output_limit:
+                        # Stop the process as soon as it produces too much
+                        output.write(data[:output_limit - written])
+                        os.killpg(main_pipe.pid, signal.SIGKILL)
+                        reap(main_pipe, usage, start)
+                        raise OutputLimitExceeded()
+                    output.write(data)
+                    written += len(data)
                     if event == select.POLLHUP:
                         poll.unregister(file_descriptor)
                         do_poll = False
 
+            saved = os.path.join(tmp_dir, save[0]) if save else None
+            while saved and output_limit and \
+                    reap(main_pipe, usage, start, os.WNOHANG) is None:
+                if time.time() - start >= time_limit:
+                    os.killpg(main_pipe.pid, signal.SIGKILL)
+                    reap(main_pipe, usage, start)
+                    raise TimeoutException()
+                try:
+                    size = os.path.getsize(saved)
+                except OSError:  # Not yet written
+                    size = 0
+                if size > output_limit:
+                    os.killpg(main_pipe.pid, signal.SIGKILL)
+                    reap(main_pipe, usage, start)
+                    raise OutputLimitExceeded()
+                time.sleep(SAVE_POLL_INTERVAL)
+
             signal.signal(signal.SIGALRM, alarm_handler)
             signal.alarm(time_limit)
             try:
-                main_status = main_pipe.wait()
+                main_status = reap(main_pipe, usage, start)
                 signal.alarm(0)
             except TimeoutAlarm:
                 os.killpg(main_pipe.pid, signal.SIGKILL)
+                reap(main_pipe, usage, start)
                 raise TimeoutException()
             if main_status < 0:
                 raise SignalException(-1 * main_status)
@@ -124,21 +369,94 @@ class Worker(object):
                     shutil.copy(src, save[1])
             shutil.rmtree(tmp_dir)
 
-    def __init__(self):
+    def __init__(self, path='working', home=None):
+        self.home = home or os.getcwd()
         # Load testable information
-        os.chdir('working')
+        os.chdir(path)
+        self.path = os.getcwd()
         with open('data.json') as fp:
             self.data = json.load(fp)
+        self.manifest = None
+        if os.path.isfile(MANIFEST_FILE):
+            with open(MANIFEST_FILE) as fp:
+                self.manifest = json.load(fp)
+        self.builds = {}  # Builds of the job by build key (see make_project)
+        self.returned_build = None
+        self.timings = {}
+
+    def materialize(self):
+        """Build the working directory from the manifest and blob cache.
+
+        The proxy sends the submitted files with the job, and the cache only
+        holds files the tests may see, e.g., inputs and execution files.
+        Cached files are hardlinked (copied when that fails). Every file is
+        checked against its sha1 in the manifest, which was read before any
+        test ran, as the tests run with the same permissions as the worker.
+        The cached blobs are made read-only so that a job cannot modify the
+        cache through one of its links by accident, and are touched to mark
+        them as recently used (see `prune_blobs`).
+
+        """
+        for path in (SRC_PATH, INPUT_PATH, EXECUTION_FILES_PATH):
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        if self.manifest is None:
+            return
+        for path, sha1 in self.manifest.items():
+            if os.path.lexists(path):  # Sent with the job
+                if file_sha1(path) != sha1:
+                    raise CorruptFile(path)
+                continue
+            source = blob_path(self.home, sha1)
+            mode = os.stat(source).st_mode
+            if mode & 0o222:
+                os.chmod(source, mode & ~0o222)
+            os.utime(source, None)
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copy(source, path)
+            if file_sha1(path) != sha1:
+                # The proxy sends the blob again with the next job
+                os.unlink(source)
+                raise CorruptFile(source)
+
+    def cleanup(self):
+        """Remove the files of the job, leaving only its results."""
+        for path in (SRC_PATH, INPUT_PATH, EXECUTION_FILES_PATH, BUILD_PATH):
+            if os.path.isdir(path):
+                remove_tree(path)
 
     def run(self):
+        if 'testables' in self.data:
+            return self.run_batch()
+        try:
+            self.run_testable()
+        finally:
+            # Submitted files are not kept on the worker
+            self.cleanup()
+
+    def run_testable(self):
         # Build and run tests
+        start = time.time()
+        self.materialize()
+        self.timings['materialize'] = time.time() - start
         os.mkdir(RESULTS_PATH)
         result = {}
         try:
             if self.data['make_target']:
-                result['make'] = self.make_project(self.data['executable'],
-                                                   self.data['make_target'])
+                start = time.time()
+                try:
+                    result['make'] = self.make_project(
+                        self.data['executable'], self.data['make_target'])
+                finally:
+                    self.timings['make'] = time.time() - start
+            start = time.time()
             self.run_tests(self.data['test_cases'])
+            self.timings['tests'] = time.time() - start
             result['status'] = 'success'
         except (MakeFailed, NonexistentExecutable) as exc:
             # Truncate and replace invalid ascii characters
@@ -149,9 +467,92 @@ class Worker(object):
         # Save results
         with open(os.path.join(RESULTS_PATH, 'testable'), 'w') as fp:
             json.dump(result, fp)
+        with open(os.path.join(RESULTS_PATH, 'timings'), 'w') as fp:
+            json.dump(self.timings, fp)
+        if self.returned_build:
+            self.return_build(self.returned_build)
+
+    def run_batch(self):
+        """Run each testable of a batched job within its own directory.
+
+        The specification of every testable is loaded before any of them
+        runs, so the tests cannot change what a later testable does.
+        Testables with the same build key are built only once.
+
+        """
+        if os.path.exists(RESULTS_ARCHIVE):
+            os.unlink(RESULTS_ARCHIVE)
+        workers = []
+        for testable_id in self.data['testables']:
+            workers.append(Worker('t_{}'.format(testable_id), self.home))
+            os.chdir(self.path)
+        for worker in workers:
+            worker.builds = self.builds
+            os.chdir(worker.path)
+            try:
+                worker.run()
+            finally:
+                os.chdir(self.path)
+        if self.data.get('pack_results'):
+            self.pack_results()
+
+    def pack_results(self):
+        """Pack the results of every testable into a single archive.
+
+        The proxy fetches the archive with one ssh round trip instead of
+        rsyncing the working directory.
+
+        """
+        tmp_path = RESULTS_ARCHIVE + '.tmp'
+        archive = tarfile.open(tmp_path, 'w:gz', compresslevel=6)
+        try:
+            for testable_id in self.data['testables']:
+                path = os.path.join('t_{}'.format(testable_id), 'results')
+                if os.path.isdir(path):
+                    archive.add(path)
+        finally:
+            archive.close()
+        os.rename(tmp_path, RESULTS_ARCHIVE)
 
     def make_project(self, executable, target):
-        """Build the project and verify the executable exists."""
+        """Build the project and verify the executable exists.
+
+        The build is reused, rather than made, when an earlier testable of
+        the job has the same `build_key`, or when the proxy sent one from its
+        build cache (`build_cache`). The files of a build sent by the proxy
+        are checked against the sha1s in the data specification. A new build
+        is kept in memory, and returned with the results when the proxy asks
+        for it (`return_build`).
+
+        """
+        key = self.data.get('build_key')
+        build = self.builds.get(key) if key else None
+        if build:
+            for name, (mode, data) in build['files'].items():
+                write_file(os.path.join(SRC_PATH, name), data, mode)
+        elif self.data.get('build_cache'):
+            build = self.data['build_cache']
+            for name, sha1 in build['files'].items():
+                path = os.path.join(SRC_PATH, name)
+                if os.path.lexists(path):
+                    os.unlink(path)
+                elif not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                copy_file(os.path.join(BUILD_PATH, name), path)
+                if file_sha1(path) != sha1:
+                    raise CorruptFile(path)
+        if build:
+            self.timings['build_cache'] = {'hit': True,
+                                           'saved': build['duration']}
+            output = build['output'].encode('latin-1')
+            if not os.path.isfile(os.path.join(SRC_PATH, executable)):
+                raise NonexistentExecutable(output)
+            return output
+        if key:
+            self.timings['build_cache'] = {'hit': False, 'saved': 0}
+
+        before = snapshot(SRC_PATH)
+        start = time.time()
         command = 'make -f ../Makefile -C {0} {1}'.format(SRC_PATH, target)
         pipe = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT,
                      env=CHILD_ENV)
@@ -160,65 +561,157 @@ class Worker(object):
             raise MakeFailed(output)
         if not os.path.isfile(os.path.join(SRC_PATH, executable)):
             raise NonexistentExecutable(output)
+        if key:
+            self.keep_build(key, before, output, time.time() - start)
         return output
 
+    def keep_build(self, key, before, output, duration):
+        """Keep the files make created or changed in SRC_PATH in memory."""
+        files = {}
+        size = 0
+        for name, signature in snapshot(SRC_PATH).items():
+            if before.get(name) == signature:
+                continue
+            path = os.path.join(SRC_PATH, name)
+            size += os.path.getsize(path)
+            if size > MAX_BUILD_SIZE:
+                return
+            with open(path, 'rb') as fp:
+                files[name] = (stat.S_IMODE(os.stat(path).st_mode), fp.read())
+        build = {'duration': duration, 'files': files,
+                 'output': output.decode('latin-1')}
+        self.builds[key] = build
+        if self.data.get('return_build'):
+            self.returned_build = build
+
+    def return_build(self, build):
+        """Save the build in the results for the proxy's build cache.
+
+        The build is written from memory once the tests are done as they
+        could have modified its files in SRC_PATH.
+
+        """
+        modes = {}
+        for name, (mode, data) in build['files'].items():
+            write_file(os.path.join(RESULTS_PATH, BUILD_PATH, name), data,
+                       mode)
+            modes[name] = mode
+        with open(os.path.join(RESULTS_PATH, 'build.json'), 'w') as fp:
+            json.dump({'duration': build['duration'], 'files': modes,
+                       'output': build['output']}, fp)
+
     def run_tests(self, test_cases):
+        processes = self.concurrency(len(test_cases))
+        run = functools.partial(run_test_case,
+                                sandbox=Sandbox(EXECUTION_FILES_PATH))
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                outcomes = pool.map(run, test_cases)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            outcomes = [run(tc) for tc in test_cases]
+        results = {}
+        self.timings['test_cases'] = {}
+        for tc_id, result, timing in outcomes:
+            results[tc_id] = result
+            self.timings['test_cases'][tc_id] = timing
+        with open(os.path.join(RESULTS_PATH, 'test_cases'), 'w') as fp:
+            json.dump(results, fp)
+
+    def concurrency(self, num_test_cases):
+        """Return the number of test cases to run simultaneously.
+
+        A `concurrency` of 0 in the data specification uses every core on the
+        machine. The value is always bounded by the number of cores.
+
+        """
+        cores = multiprocessing.cpu_count()
+        value = self.data.get('concurrency', 1)
+        if not value:
+            value = cores
+        return max(1, min(value, cores, num_test_cases))
+
+    @staticmethod
+    def run_test(tc, sandbox=None):
+        """Run a single test case and return its result dictionary.
+
+        Each test case executes in its own temporary directory and process
+        group, and writes to its own output file, thus multiple test cases can
+        run at the same time.
+
+        """
         def execute(*args, **kwargs):
             try:
-                result['extra'] = self.execute(*args, **kwargs)
+                result['extra'] = Worker.execute(*args, usage=result,
+                                                 sandbox=sandbox, **kwargs)
                 result['status'] = 'success'
             except NonexistentExecutable:
                 result['status'] = 'nonexistent_executable'
+            except OutputLimitExceeded:
+                result['status'] = 'output_limit_exceeded'
             except SignalException as exc:
-                result['extra'] = exc.signum
-                result['status'] = 'signal'
+                if exc.signum == signal.SIGXFSZ:  # RLIMIT_FSIZE was reached
+                    result['status'] = 'output_limit_exceeded'
+                else:
+                    result['extra'] = exc.signum
+                    result['status'] = 'signal'
             except TimeoutException:
                 result['status'] = 'timed_out'
 
-        results = {}
-        for tc in test_cases:
-            output_file = os.path.join(RESULTS_PATH, 'tc_{0}'.format(tc['id']))
-            if tc['stdin']:
-                stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
-                stdin = open(stdin_file)
-            else:
-                stdin = None
-            result = {'extra': None}
-
-            max_file_size = MAX_FILE_SIZE
-            # Mange output file
-            if tc['source'] != 'file':
-                with open(output_file, 'wb') as output:
-                    if tc['source'] == 'stdout':
-                        stdout = output
-                        stderr = None
-                    else:
-                        stdout = None
-                        stderr = output
-                    execute(tc['args'], stderr=stderr, stdin=stdin,
-                            stdout=stdout)
-            else:
-                execute(tc['args'], save=(tc['output_filename'], output_file))
-                if tc['output_filename'].endswith('.png'):
-                    max_file_size = 131072  # Avoid truncating images
-
-            if not os.path.isfile(output_file):
-                # Hack on this status until we update the ENUM
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            elif os.path.getsize(output_file) > max_file_size:
-                # Truncate output file size
-                print('\ttruncating outputfile', os.path.getsize(output_file))
-                fd = os.open(output_file, os.O_WRONLY)
-                os.ftruncate(fd, max_file_size)
-                os.close(fd)
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            results[tc['id']] = result
-        with open(os.path.join(RESULTS_PATH, 'test_cases'), 'w') as fp:
-            json.dump(results, fp)
+        output_file = os.path.join(RESULTS_PATH, 'tc_{0}'.format(tc['id']))
+        if tc['stdin']:
+            stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
+            stdin = open(stdin_file)
+        else:
+            stdin = None
+        result = {'extra': None}
+
+        max_file_size = MAX_FILE_SIZE
+        # Mange output file
+        if tc['source'] != 'file':
+            with open(output_file, 'wb') as output:
+                if tc['source'] == 'stdout':
+                    stdout = output
+                    stderr = None
+                else:
+                    stdout = None
+                    stderr = output
+                execute(tc['args'], stderr=stderr, stdin=stdin,
+                        stdout=stdout, output_limit=max_file_size)
+        else:
+            if tc['output_filename'].endswith('.png'):
+                max_file_size = 131072  # Avoid truncating images
+            execute(tc['args'], save=(tc['output_filename'], output_file),
+                    output_limit=max_file_size,
+                    file_size_limit=FILE_SIZE_BACKSTOP)
+
+        if not os.path.isfile(output_file):
+            # Hack on this status until we update the ENUM
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        elif os.path.getsize(output_file) > max_file_size:
+            # Truncate output file size
+            print('\ttruncating outputfile', os.path.getsize(output_file))
+            fd = os.open(output_file, os.O_WRONLY)
+            os.ftruncate(fd, max_file_size)
+            os.close(fd)
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        elif tc.get('expected_sha1') and \
+                file_sha1(output_file) == tc['expected_sha1']:
+            # Matching outputs need not be returned
+            os.unlink(output_file)
+            result['matches'] = True
+        return result
+
+
+class CorruptFile(Exception):
+    """Indicate that a file does not match its sha1."""
 
 
 class MakeFailed(Exception):
@@ -239,6 +732,127 @@ class TimeoutException(Exception):
     """Indicate that a process's execution timed out."""
 
 
+class OutputLimitExceeded(Exception):
+    """Indicate that a process produced more output than allowed."""
+
+
+def run_test_case(tc, sandbox=None):
+    """Return a (test case id, result, timing) tuple for the test case.
+
+    The timing contains the wall time and the CPU time of the child processes
+    that were waited on. As each process in the pool runs a single test case
+    at a time the latter is attributable to the test case.
+
+    This function is defined at the module level so that it can be used with a
+    multiprocessing pool.
+
+    """
+    start = time.time()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = Worker.run_test(tc, sandbox)
+    cpu = cpu_time(resource.getrusage(resource.RUSAGE_CHILDREN)) - \
+        cpu_time(usage)
+    return tc['id'], result, {'cpu': cpu, 'wall': time.time() - start}
+
+
+class WorkerDaemon(object):
+    """Run jobs on behalf of a long-lived proxy connection.
+
+    Requests and responses are single-line JSON objects. Each `run` request
+    forks a child that performs exactly what `main` does, so every job still
+    starts from a clean process while the interpreter startup and the SSH
+    connection are paid for only once.
+
+    """
+
+    def __init__(self):
+        self.home = os.getcwd()
+
+    def handle(self, request):
+        action = request.get('action')
+        if action == 'ping':
+            return {'status': 'ok'}
+        elif action == 'kill':
+            return {'status': 'ok', 'killed': self.kill_processes()}
+        elif action == 'run':
+            return self.run_job()
+        return {'status': 'error', 'message': 'Invalid action: {0}'
+                .format(action)}
+
+    def kill_processes(self):
+        """Kill every process owned by this user but the daemon's ancestry."""
+        keep = set()
+        pid = os.getpid()
+        while pid > 1:
+            keep.add(pid)
+            with open('/proc/{0}/stat'.format(pid)) as fp:
+                pid = int(fp.read().rsplit(')', 1)[1].split()[1])
+        killed = 0
+        uid = os.getuid()
+        for name in os.listdir('/proc'):
+            if not name.isdigit() or int(name) in keep:
+                continue
+            try:
+                if os.stat(os.path.join('/proc', name)).st_uid != uid:
+                    continue
+                os.kill(int(name), signal.SIGKILL)
+                killed += 1
+            except OSError:  # The process already exited
+                pass
+        return killed
+
+    def run_job(self):
+        error_file = os.path.join(self.home, 'worker.err')
+        pid = os.fork()
+        if pid == 0:  # Child: detach from the protocol streams and run
+            status = 1
+            try:
+                os.chdir(self.home)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull, 0)
+                os.dup2(devnull, 1)
+                err = os.open(error_file,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.dup2(err, 2)
+                os.setsid()
+                status = main()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status or 0)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            return {'status': 'success'}
+        with open(error_file) as fp:
+            output = fp.read()
+        return {'status': 'failed', 'output': output[-MAX_FILE_SIZE:]}
+
+    def serve(self, rfile, wfile):
+        """Handle requests from `rfile` until it is closed."""
+        for line in iter(rfile.readline, ''):
+            try:
+                response = self.handle(json.loads(line))
+            except Exception:
+                response = {'status': 'error',
+                            'message': traceback.format_exc()}
+            wfile.write(json.dumps(response) + '\n')
+            wfile.flush()
+
+    def serve_socket(self, path):
+        """Handle connections, one at a time, on a unix domain socket."""
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        while True:
+            conn, _ = server.accept()
+            try:
+                self.serve(conn.makefile('r'), conn.makefile('w'))
+            finally:
+                conn.close()
+
+
 def main():
     with open('worker.log', 'a') as fp:
         wp = Worker()
@@ -247,6 +861,11 @@ def main():
         try:
             wp.run()
             status = 'success'
+            if wp.data.get('blob_cache_size'):
+                try:
+                    prune_blobs(wp.home, wp.data['blob_cache_size'])
+                except (IOError, OSError):  # The job itself succeeded
+                    traceback.print_exc(file=fp)
             return 0
         except Exception:
             traceback.print_exc(file=fp)
@@ -259,4 +878,15 @@ def main():
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true',
+                        help='handle jobs from stdin until it is closed')
+    parser.add_argument('--socket', help=('handle jobs from connections to '
+                                          'this unix domain socket'))
+    args = parser.parse_args()
+    if args.socket:
+        WorkerDaemon().serve_socket(args.socket)
+    elif args.daemon:
+        WorkerDaemon().serve(sys.stdin, sys.stdout)
+    else:
+        sys.exit(main())